@@ -0,0 +1 @@
+NormalizeCompression decides what to recompress from the gzip and bzip2 headers alone, without building magic
@@ -0,0 +1 @@
+Strip copies debug sources in parallel, reflinking where supported and hard linking identical sources in the destdir
@@ -0,0 +1 @@
+NormalizeInfoPages classifies info files from their headers and recompresses them in process and in batched gzip commands
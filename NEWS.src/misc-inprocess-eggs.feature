@@ -0,0 +1 @@
+NormalizePythonEggs unpacks eggs in process and in parallel, falling back to unzip for archives it cannot reproduce exactly
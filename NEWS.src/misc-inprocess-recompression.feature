@@ -0,0 +1 @@
+NormalizeCompression recompresses bzip2 files in process and gzip files with one gzip command per batch, using the build's job count
@@ -0,0 +1 @@
+NormalizePythonInterpreterVersion finds other names of an interpreter from a per-directory index instead of comparing against every file in the directory
@@ -0,0 +1 @@
+Build log requirement policies reject config.log and CMakeCache.txt lines that no pattern can match with a single combined expression
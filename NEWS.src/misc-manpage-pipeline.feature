@@ -0,0 +1 @@
+NormalizeManPages walks each man tree once, uncompresses pages in process and recompresses them in batched gzip commands
@@ -0,0 +1 @@
+NormalizeManPages checks and rewrites pages a block at a time, and only replaces pages whose contents change
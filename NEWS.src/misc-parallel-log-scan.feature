@@ -0,0 +1 @@
+Build log requirement policies scan config.log and CMakeCache.txt files in parallel worker processes when more than one job is allowed, merging what they find in path order
@@ -0,0 +1 @@
+Read-only enforcement checks that Conary runs one after another, such as NonBinariesInBindirs, CheckDesktopFiles, CheckDestDir and WarnWriteable now run concurrently when the policyjobs macro or the -j value in parallelmflags allows more than one job; their messages are replayed in the usual order.
@@ -0,0 +1 @@
+The Strip policy now runs debugedit and strip for up to policyjobs (or the parallelmflags -j value) files at once.
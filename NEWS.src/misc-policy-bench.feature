@@ -0,0 +1 @@
+scripts/policybench.py runs policies over synthetic destdir, builddir and system root trees through a stub recipe, autopkg and local database, and reports throughput in files per second without a cook.
@@ -0,0 +1 @@
+Setting the CONARY_POLICY_CACHE environment variable to a directory keeps the results of NormalizeCompression and the NormalizeManPages content cleanup per package, keyed on file contents, so that unchanged files are not processed again when the package is rebuilt; entries unused for ten builds are dropped.
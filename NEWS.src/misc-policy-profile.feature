@@ -0,0 +1 @@
+Setting the CONARY_POLICY_PROFILE environment variable to a file or directory name now writes a JSON report of wall time, CPU time, files visited, doFile calls, subprocesses and database queries for every conary-policy policy run during a cook.
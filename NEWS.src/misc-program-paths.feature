@@ -0,0 +1 @@
+Policies look up each program they run once per cook, and report the trove providing it to the buildRequires checks once
@@ -0,0 +1 @@
+NormalizePamConfig and NormalizeInitscriptContents leave files they do not change untouched
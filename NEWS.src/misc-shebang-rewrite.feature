@@ -0,0 +1 @@
+NormalizeInterpreterPaths and NormalizePythonInterpreterVersion rewrite only the interpreter line, moving the rest of a script only when that line changes length
@@ -0,0 +1 @@
+Strip now strips hard links and byte-identical files once, linking their debug files, and with CONARY_POLICY_CACHE set reuses stripped output from earlier cooks of unchanged files.
@@ -0,0 +1,1237 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Helpers shared between conary-policy modules.
+
+Policy modules are loaded individually by path rather than imported
+as a package, so they cannot import each other.  Each module that
+needs these helpers loads this file from its own directory:
+
+    _policyutil = sys.modules.get('_policyutil') or imp.load_source(
+        '_policyutil', os.path.join(os.path.dirname(__file__),
+                                    '_policyutil.py'))
+
+This module must not define any policy classes.  State that needs to
+live for the length of a cook is stored on the recipe object, never
+in module globals, because this module may be loaded more than once.
+
+Every policy module ends with a call to L{profilePolicies}, which
+instruments its policies when the C{CONARY_POLICY_PROFILE} environment
+variable is set; see L{profilePolicies} for details.  Modules with
+policies that only report on files also call L{declareReadOnly}.
+"""
+
+import cPickle
+import os
+import re
+import shutil
+import stat
+import sys
+import time
+import types
+
+try:
+    from hashlib import sha1 as _sha1
+except ImportError:
+    # python 2.4
+    from sha import new as _sha1
+
+try:
+    import json
+except ImportError:
+    # python 2.5 and earlier
+    json = None
+
+try:
+    import threading
+except ImportError:
+    # python built without thread support
+    threading = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from conary.lib import util
+from conary.local import database
+
+
+class _DatabaseHandle(object):
+    """
+    Lazily opened local database handle.  Policy never closes it; it
+    stays open for every later policy to use, and goes away with the
+    recipe at the end of the cook.
+    """
+
+    def __init__(self, root, dbPath, db=None):
+        self.root = root
+        self.dbPath = dbPath
+        self.db = None
+        self.opens = 0
+        if db is not None:
+            self.setDatabase(db)
+
+    def setDatabase(self, db):
+        if os.environ.get(PROFILE_ENV):
+            db = _CountingDatabase(db)
+        self.db = db
+
+    def get(self):
+        if self.db is None:
+            self.setDatabase(database.Database(self.root, self.dbPath))
+            self.opens += 1
+        return self.db
+
+
+def _getDatabaseHandle(recipe, root):
+    cfg = recipe.cfg
+    if root is None:
+        root = cfg.root
+    handles = getattr(recipe, '_policyDatabases', None)
+    if handles is None:
+        handles = recipe._policyDatabases = {}
+    key = (root, cfg.dbPath)
+    handle = handles.get(key)
+    if handle is None:
+        db = None
+        if root == cfg.root:
+            # the database the cook itself set up, if any
+            db = getattr(recipe, '_db', None)
+        handle = handles[key] = _DatabaseHandle(root, cfg.dbPath, db)
+    return handle
+
+
+def openDatabase(recipe, root=None):
+    """
+    Return the local database shared by all policies in this cook:
+    C{recipe._db} if the cook provides one, otherwise a database
+    opened the first time it is needed.  It stays open for the rest
+    of the cook, so callers do not close it.  C{root} defaults to
+    C{recipe.cfg.root}.
+    """
+    return _getDatabaseHandle(recipe, root).get()
+
+
+def useDatabase(recipe, db, root=None):
+    """
+    Make C{db} the local database that L{openDatabase} returns for
+    this recipe, instead of opening C{recipe.cfg.dbPath}.  For tools
+    that run policy outside of a cook, such as the benchmark in
+    C{scripts/policybench.py}.
+    """
+    _getDatabaseHandle(recipe, root).setDatabase(db)
+
+
+class _CapsulePaths(object):
+    """
+    Records which paths belong to capsules.  Each path is checked with
+    the recipe at most once per cook, however many policies ask.
+    """
+
+    def __init__(self, recipe):
+        self.getCapsulePaths = getattr(recipe, '_getCapsulePathsForFile',
+                                       None)
+        self.capsulePaths = set()
+        self.otherPaths = set()
+
+    def __contains__(self, path):
+        if path in self.otherPaths:
+            return False
+        if path in self.capsulePaths:
+            return True
+        if self.getCapsulePaths is None:
+            # older Conary without capsule support
+            return False
+        if self.getCapsulePaths(path):
+            self.capsulePaths.add(path)
+            return True
+        self.otherPaths.add(path)
+        return False
+
+
+def isCapsulePath(recipe, path):
+    capsulePaths = getattr(recipe, '_policyCapsulePaths', None)
+    if capsulePaths is None:
+        capsulePaths = recipe._policyCapsulePaths = _CapsulePaths(recipe)
+    return path in capsulePaths
+
+
+def skipCapsuleFiles(method):
+    """
+    Decorator for C{doFile} and similar per-path methods, whose first
+    argument after C{self} is a path, that keeps capsule files from
+    ever reaching the method.
+    """
+    def wrapper(self, path, *args, **keywords):
+        if isCapsulePath(self.recipe, path):
+            return None
+        return method(self, path, *args, **keywords)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class PathTroveLookup(object):
+    """
+    Memoizing front end for C{db.iterTrovesByPath()}; both hits and
+    misses are cached, since the local database does not change while
+    policy is running.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def iterTrovesByPath(self, path):
+        troveList = self.cache.get(path)
+        if troveList is None:
+            self.misses += 1
+            troveList = self.cache[path] = list(self.db.iterTrovesByPath(path))
+        else:
+            self.hits += 1
+        # callers are allowed to modify the list they get back
+        return list(troveList)
+
+    def getTrovesByPaths(self, paths):
+        # the local database has no multi-path query, so this is one
+        # memoized query per distinct path, returning a dict mapping
+        # every path asked for to its list of troves
+        return dict((path, self.iterTrovesByPath(path))
+                    for path in set(paths))
+
+    def getTroveNamesByPath(self, path):
+        return [x.getName() for x in self.iterTrovesByPath(path)]
+
+    def hitRate(self):
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return float(self.hits) / total
+
+    def getStats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'paths': len(self.cache),
+                'hitRate': self.hitRate()}
+
+
+def getPathLookup(recipe):
+    """
+    Return the path to trove lookup shared by every policy in this cook
+    """
+    lookup = getattr(recipe, '_policyPathLookup', None)
+    if lookup is None:
+        lookup = PathTroveLookup(openDatabase(recipe))
+        recipe._policyPathLookup = lookup
+    return lookup
+
+
+class _ProgramPaths(object):
+    """
+    Where the programs that policies run were found in this cook, and
+    which troves providing them have been reported to the
+    buildRequires checks.
+    """
+
+    def __init__(self, recipe):
+        self.recipe = recipe
+        self.paths = {}
+        self.reported = set()
+
+    def _searchPath(self):
+        macros = self.recipe.macros
+        searchPath = [macros.essentialbindir,
+                      macros.bindir,
+                      macros.essentialsbindir,
+                      macros.sbindir]
+        searchPath.extend([x for x in ['/bin', '/usr/bin', '/sbin', '/usr/sbin']
+                           if x not in searchPath])
+        searchPath.extend([x for x in os.getenv('PATH', '').split(os.path.pathsep)
+                           if x not in searchPath])
+        return searchPath
+
+    def find(self, prog, error=True):
+        # ignore arguments
+        prog = prog.split(' ')[0]
+        if prog in self.paths:
+            progPath = self.paths[prog]
+            if progPath is None and error:
+                # raise the same error as the first search
+                util.searchFile(prog, self._searchPath(), error=error)
+            return progPath
+
+        if prog.startswith('/'):
+            progPath = prog
+        else:
+            progPath = util.searchFile(prog, self._searchPath(), error=error)
+        self.paths[prog] = progPath
+        if progPath:
+            self._report(progPath)
+        return progPath
+
+    def _report(self, progPath):
+        lookup = getPathLookup(self.recipe)
+        progTroveName = lookup.getTroveNamesByPath(progPath)
+        if not progTroveName:
+            return
+        progTroveName = progTroveName[0]
+        if progTroveName in self.reported:
+            return
+        self.reported.add(progTroveName)
+        recipe = self.recipe
+        try:
+            if progTroveName in recipe._getTransitiveBuildRequiresNames():
+                recipe.reportExcessBuildRequires(progTroveName)
+            else:
+                recipe.reportMissingBuildRequires(progTroveName)
+        except AttributeError:
+            # older conary
+            pass
+
+
+def findProgPath(prog, recipe, error=True):
+    """
+    Return the path to C{prog}, ignoring any arguments given with it,
+    searching the recipe's bin and sbin directories and then C{$PATH}.
+    Each program is searched for once per cook, and the trove providing
+    it is reported to the buildRequires checks the first time any of
+    its programs is found.  If C{prog} is not found, raises an error,
+    or returns C{None} if C{error} is C{False}.
+    """
+    programs = getattr(recipe, '_policyProgramPaths', None)
+    if programs is None:
+        programs = recipe._policyProgramPaths = _ProgramPaths(recipe)
+    return programs.find(prog, error=error)
+
+
+# Parallel execution
+
+_jobsRe = re.compile(r'(?:^|\s)(?:-j\s*|--jobs=)([0-9]+)')
+
+
+def getJobCount(recipe):
+    """
+    Return how many jobs policy may run at once: the C{policyjobs}
+    macro if it is set, otherwise the C{-j} value in
+    C{parallelmflags}, otherwise 1.
+    """
+    macros = recipe.macros
+    try:
+        return max(1, int(macros['policyjobs']))
+    except (KeyError, ValueError):
+        pass
+    try:
+        match = _jobsRe.search(macros['parallelmflags'])
+    except KeyError:
+        match = None
+    if match:
+        return max(1, int(match.group(1)))
+    return 1
+
+
+def parallelMap(function, items, jobs):
+    """
+    Return C{[function(x) for x in items]}, computed by up to C{jobs}
+    threads.  Results are in the order of C{items} whatever order the
+    calls finish in.  If any call raises an exception, the exception
+    from the first such item is raised once all calls have finished.
+    """
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1 or threading is None:
+        return [function(x) for x in items]
+
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    lock = threading.Lock()
+    nextItem = [0]
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                index = nextItem[0]
+                nextItem[0] += 1
+            finally:
+                lock.release()
+            if index >= len(items):
+                return
+            try:
+                results[index] = function(items[index])
+            except:
+                errors[index] = sys.exc_info()
+
+    threads = [threading.Thread(target=worker)
+               for x in range(min(jobs, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return results
+
+
+def processMap(function, items, jobs):
+    """
+    Return C{[function(x) for x in items]}, computed by up to C{jobs}
+    forked processes, for work such as regular expression matching
+    that threads cannot run at once.  Each process returns its results
+    pickled, so the results must be picklable, and any other effect of
+    C{function} is lost.  Results are in the order of C{items}.  If any
+    call raises an exception, the exception from the first such item
+    is raised once all processes have finished.
+    """
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1 or not hasattr(os, 'fork'):
+        return [function(x) for x in items]
+
+    jobs = min(jobs, len(items))
+    # output buffered now would otherwise be written by every child
+    sys.stdout.flush()
+    sys.stderr.flush()
+    children = []
+    for job in range(jobs):
+        indexes = range(job, len(items), jobs)
+        readFd, writeFd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                try:
+                    os.close(readFd)
+                    out = os.fdopen(writeFd, 'wb')
+                    for index in indexes:
+                        try:
+                            result = (function(items[index]), None)
+                        except Exception, e:
+                            result = (None, e)
+                        failed = result[1] is not None
+                        try:
+                            data = cPickle.dumps(result, 2)
+                        except Exception, e:
+                            # an unpicklable result or exception
+                            data = cPickle.dumps((None, RuntimeError(
+                                '%s: %s' %(items[index], result[1] or e))),
+                                2)
+                            failed = True
+                        out.write(data)
+                        if failed:
+                            break
+                    out.close()
+                except:
+                    status = 1
+            finally:
+                os._exit(status)
+        os.close(writeFd)
+        children.append((pid, indexes, os.fdopen(readFd, 'rb')))
+
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    for pid, indexes, f in children:
+        try:
+            for index in indexes:
+                try:
+                    results[index], errors[index] = cPickle.load(f)
+                except EOFError:
+                    errors[index] = RuntimeError(
+                        'worker process %d exited early' %pid)
+                if errors[index] is not None:
+                    break
+        finally:
+            f.close()
+            os.waitpid(pid, 0)
+    for error in errors:
+        if error is not None:
+            raise error
+    return results
+
+
+_messageMethods = ('dbg', 'debug', 'info', 'warn', 'error')
+
+
+def _messageRecorder(messages, name):
+    def record(*args, **keywords):
+        messages.append((name, args, keywords))
+    return record
+
+
+def _runBuffered(policyObj, recipe):
+    # run the check with its messages held back for replay
+    messages = []
+    saved = []
+    for name in _messageMethods:
+        if not hasattr(policyObj, name):
+            continue
+        saved.append((name, policyObj.__dict__.get(name)))
+        setattr(policyObj, name, _messageRecorder(messages, name))
+    try:
+        try:
+            policyObj._policyReadOnlyDoProcess(recipe)
+        except:
+            return messages, sys.exc_info()
+    finally:
+        _restoreMessages(policyObj, saved)
+    return messages, None
+
+
+def _isReadOnly(policyObj):
+    # subclasses of a read-only policy are not read-only themselves
+    cls = policyObj.__class__
+    return getattr(cls, '_policyReadOnly', None) is cls
+
+
+class _DestdirScan(object):
+    """
+    C{os.lstat()} of every path in a tree, from a single walk that
+    calls C{os.lstat()} once per path and never follows symlinks.
+    """
+
+    def __init__(self, topdir):
+        self.stats = {}
+        dirs = [os.path.normpath(topdir)]
+        while dirs:
+            dirName = dirs.pop()
+            try:
+                names = os.listdir(dirName)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(dirName, name)
+                try:
+                    st = self.stats[path] = os.lstat(path)
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    dirs.append(path)
+
+
+def lstat(recipe, path):
+    """
+    Return C{os.lstat(path)}, from the destdir scan shared by the
+    read-only policies while they are running.
+    """
+    scan = getattr(recipe, '_policyDestdirScan', None)
+    if scan is not None:
+        st = scan.stats.get(os.path.normpath(path))
+        if st is not None:
+            return st
+    return os.lstat(path)
+
+
+class _ReadOnlyChecks(object):
+    """
+    With more than one job, when Conary runs a read-only policy, it
+    and the read-only policies that immediately follow it in Conary's
+    run order are run together, using up to L{getJobCount} threads,
+    with their messages and any exception held back.  They share a single scan of the destdir for
+    L{lstat}, which is valid because none of them changes it, and no
+    other policy can run between them.  When Conary then runs each
+    policy, its held back results are replayed, so the output is the
+    same as running the policies one by one.
+    """
+
+    def __init__(self, recipe):
+        self.results = {}
+        self.jobs = getJobCount(recipe)
+        # with one job there is nothing to gain from batching, and
+        # profiling attributes work to the single running policy, so
+        # in either case each policy does its work when Conary runs it
+        self.batch = self.jobs > 1 and not os.environ.get(PROFILE_ENV)
+
+    def _adjacentChecks(self, policyObj, recipe):
+        # policyObj and the read-only policies that Conary runs right
+        # after it, in the same bucket
+        for policyList in getattr(recipe, '_policies', {}).values():
+            for index, otherObj in enumerate(policyList):
+                if otherObj is policyObj:
+                    break
+            else:
+                continue
+            checks = []
+            for otherObj in policyList[index:]:
+                if not _isReadOnly(otherObj):
+                    break
+                checks.append(otherObj)
+            return checks
+        return [policyObj]
+
+    def runBatch(self, checks, recipe):
+        recipe._policyDestdirScan = _DestdirScan(recipe.macros.destdir)
+        try:
+            results = parallelMap(lambda x: _runBuffered(x, recipe),
+                                  checks, self.jobs)
+        finally:
+            recipe._policyDestdirScan = None
+        self.results.update(zip(checks, results))
+
+    def doProcess(self, policyObj, recipe):
+        if policyObj not in self.results and self.batch:
+            checks = self._adjacentChecks(policyObj, recipe)
+            if len(checks) > 1:
+                self.runBatch(checks, recipe)
+        result = self.results.pop(policyObj, None)
+        if result is None:
+            return policyObj._policyReadOnlyDoProcess(recipe)
+        messages, excInfo = result
+        for name, args, keywords in messages:
+            getattr(policyObj, name)(*args, **keywords)
+        if excInfo is not None:
+            raise excInfo[0], excInfo[1], excInfo[2]
+
+
+def _readOnlyDoProcess(self, recipe):
+    if not _isReadOnly(self):
+        return self._policyReadOnlyDoProcess(recipe)
+    checks = getattr(recipe, '_policyReadOnlyChecks', None)
+    if checks is None:
+        checks = recipe._policyReadOnlyChecks = _ReadOnlyChecks(recipe)
+    return checks.doProcess(self, recipe)
+
+
+def declareReadOnly(*classes):
+    """
+    Declare policies that only examine files and report on them.  They
+    must not modify the destdir, the recipe or any state shared with
+    other policies, other than through their own messages.  These
+    policies are run together in threads when L{getJobCount} is more
+    than 1, and should use L{lstat}; see L{_ReadOnlyChecks}.
+    """
+    for cls in classes:
+        cls._policyReadOnly = cls
+        cls._policyReadOnlyDoProcess = cls.doProcess.im_func
+        cls.doProcess = _readOnlyDoProcess
+
+
+# Linux FICLONE ioctl, _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+
+
+def copyFile(src, dest):
+    """
+    Copy the contents of C{src} to C{dest}, sharing storage with a
+    reflink where the filesystem supports it, and return the number of
+    bytes copied.
+    """
+    srcFile = open(src, 'rb')
+    try:
+        destFile = open(dest, 'wb')
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.ioctl(destFile.fileno(), _FICLONE,
+                                srcFile.fileno())
+                    return os.fstat(srcFile.fileno()).st_size
+                except (IOError, OSError):
+                    # not supported by this filesystem, or not
+                    # within a single filesystem
+                    pass
+            shutil.copyfileobj(srcFile, destFile, 1024 * 1024)
+            return destFile.tell()
+        finally:
+            destFile.close()
+    finally:
+        srcFile.close()
+
+
+def readRecords(f, separator, bufferSize=65536):
+    """
+    Iterate over the C{separator}-terminated records read from C{f},
+    a block at a time; a trailing unterminated record is returned
+    as well.
+    """
+    pending = ''
+    while True:
+        block = f.read(bufferSize)
+        if not block:
+            break
+        records = (pending + block).split(separator)
+        pending = records.pop()
+        for record in records:
+            yield record
+    if pending:
+        yield pending
+
+
+# Incremental policy
+
+CACHE_ENV = 'CONARY_POLICY_CACHE'
+
+
+def hashFile(path):
+    digest = _sha1()
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            digest.update(data)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+class _PolicyCache(object):
+    """
+    Results of per-file policy methods from earlier cooks of a package.
+    Each result is keyed on the policy, the source of the module that
+    defines it, the destdir, the file's path and the hash of its
+    contents, and records the hash of the contents the method left
+    behind and the messages it reported.  Changed contents are kept
+    in C{objects/}; the index is a log of pickled entries, appended to
+    as results are added or used, so that it survives however the
+    cook ends.
+
+    Every cook counts as a new generation.  When a cook loads the
+    cache, the index is rewritten with only the latest copy of each
+    entry used in the last L{keepGenerations} cooks, and objects that
+    no remaining entry names are removed.  Loading and appending hold
+    a lock on C{lock}, so that cooks of the same package running at
+    once neither interleave their entries nor lose them to a rewrite.
+    """
+
+    keepGenerations = 10
+
+    def __init__(self, cacheDir, name):
+        topdir = os.path.join(cacheDir, name)
+        self.objectDir = os.path.join(topdir, 'objects')
+        util.mkdirChain(self.objectDir)
+        self.indexPath = os.path.join(topdir, 'index')
+        self.lockFile = open(os.path.join(topdir, 'lock'), 'a')
+        self.entries = {}
+        self.used = set()
+        self.sourceDigests = {}
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._lock()
+        try:
+            generations = {}
+            if os.path.exists(self.indexPath):
+                generations = self._load()
+            self._compact(generations)
+        finally:
+            self._unlock()
+
+    def _lock(self):
+        if fcntl is not None:
+            fcntl.lockf(self.lockFile, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        if fcntl is not None:
+            fcntl.lockf(self.lockFile, fcntl.LOCK_UN)
+
+    def _load(self):
+        # entries are (key, value, generation); a None key records
+        # the generation of the cook that last rewrote the index, and
+        # a None value that an entry was used again
+        generations = {}
+        f = open(self.indexPath, 'rb')
+        try:
+            while True:
+                try:
+                    record = cPickle.load(f)
+                except EOFError:
+                    break
+                except Exception:
+                    # an entry cut short by an interrupted cook; the
+                    # rewrite drops it, so later entries are kept
+                    break
+                if len(record) == 2:
+                    # written before entries recorded their generation
+                    record += (None,)
+                key, value, generation = record
+                if key is None:
+                    self.generation = value
+                elif value is None:
+                    if key in self.entries:
+                        generations[key] = generation
+                else:
+                    self.entries[key] = value
+                    generations[key] = generation
+        finally:
+            f.close()
+        self.generation += 1
+        oldest = self.generation - self.keepGenerations
+        for key, generation in generations.items():
+            if generation is not None and generation < oldest:
+                del self.entries[key]
+                del generations[key]
+        return generations
+
+    def _compact(self, generations):
+        tmpPath = self.indexPath + '.tmp%d' %os.getpid()
+        f = open(tmpPath, 'wb')
+        try:
+            cPickle.dump((None, self.generation, None), f, 2)
+            for key, value in self.entries.iteritems():
+                generation = generations.get(key)
+                if generation is None:
+                    generation = self.generation
+                cPickle.dump((key, value, generation), f, 2)
+        finally:
+            f.close()
+        os.rename(tmpPath, self.indexPath)
+
+        # remove the objects that no entry names
+        names = set()
+        values = self.entries.values()
+        while values:
+            value = values.pop()
+            if isinstance(value, (tuple, list)):
+                values.extend(value)
+            elif isinstance(value, str):
+                names.add(value)
+        for dirName in os.listdir(self.objectDir):
+            dirPath = os.path.join(self.objectDir, dirName)
+            if not os.path.isdir(dirPath):
+                continue
+            for objectName in os.listdir(dirPath):
+                if '.tmp' in objectName or objectName in names:
+                    # being stored by another cook, or in use
+                    continue
+                try:
+                    os.unlink(os.path.join(dirPath, objectName))
+                except OSError:
+                    pass
+
+    def _append(self, data):
+        self._lock()
+        try:
+            # opened each time, since another cook may have rewritten
+            # the index since the last append
+            f = open(self.indexPath, 'ab')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+        finally:
+            self._unlock()
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None and key not in self.used:
+            # keep it from being dropped for lack of use
+            self.used.add(key)
+            self._append(cPickle.dumps((key, None, self.generation), 2))
+        return value
+
+    def put(self, key, value):
+        try:
+            data = cPickle.dumps((key, value, self.generation), 2)
+        except (cPickle.PicklingError, TypeError):
+            # reported a message that cannot be kept
+            return
+        self.entries[key] = value
+        self.used.add(key)
+        self._append(data)
+
+    def getSourceDigest(self, cls):
+        module = sys.modules.get(cls.__module__)
+        sourcePath = getattr(module, '__file__', None)
+        if sourcePath is None:
+            return None
+        if sourcePath.endswith('.pyc') or sourcePath.endswith('.pyo'):
+            sourcePath = sourcePath[:-1]
+        digest = self.sourceDigests.get(sourcePath)
+        if digest is None:
+            digest = self.sourceDigests[sourcePath] = hashFile(sourcePath)
+        return digest
+
+    def _objectPath(self, digest):
+        return os.path.join(self.objectDir, digest[:2], digest)
+
+    def hasObject(self, digest):
+        return os.path.exists(self._objectPath(digest))
+
+    def storeObject(self, path, digest):
+        objectPath = self._objectPath(digest)
+        if os.path.exists(objectPath):
+            return
+        util.mkdirChain(os.path.dirname(objectPath))
+        tmpPath = objectPath + '.tmp%d' %os.getpid()
+        shutil.copyfile(path, tmpPath)
+        os.rename(tmpPath, objectPath)
+
+    def restoreObject(self, digest, path):
+        # an existing file is rewritten in place, as the policies
+        # themselves do, so that hard links and modes are kept
+        try:
+            mode = os.lstat(path).st_mode
+        except OSError:
+            mode = None
+        if mode is not None:
+            os.chmod(path, mode | 0600)
+        src = open(self._objectPath(digest), 'rb')
+        dest = open(path, 'wb')
+        try:
+            shutil.copyfileobj(src, dest)
+        finally:
+            src.close()
+            dest.close()
+        if mode is not None:
+            os.chmod(path, mode)
+
+
+def getPolicyCache(recipe):
+    """
+    Return the cache of results from earlier cooks of this package, or
+    C{None} unless C{CONARY_POLICY_CACHE} names a directory.  See
+    L{cachedFile} for the usual way to use it.
+    """
+    if not os.environ.get(CACHE_ENV):
+        return None
+    cache = getattr(recipe, '_policyCache', None)
+    if cache is None:
+        cache = _PolicyCache(os.environ[CACHE_ENV], recipe.name)
+        recipe._policyCache = cache
+    return cache
+
+
+def _teeMessages(policyObj, messages):
+    # record messages as they are reported; returns the attributes
+    # to put back afterwards
+    saved = []
+    for name in _messageMethods:
+        if not hasattr(policyObj, name):
+            continue
+        saved.append((name, policyObj.__dict__.get(name)))
+        report = getattr(policyObj, name)
+        def tee(*args, **keywords):
+            messages.append((tee.name, args, keywords))
+            return tee.report(*args, **keywords)
+        tee.name = name
+        tee.report = report
+        setattr(policyObj, name, tee)
+    return saved
+
+
+def _restoreMessages(policyObj, saved):
+    for name, value in saved:
+        if value is None:
+            delattr(policyObj, name)
+        else:
+            setattr(policyObj, name, value)
+
+
+def getFileCacheKey(policyObj, name, path, args=(), keywords={}):
+    """
+    Return the cache key for running C{policyObj}'s per-file method
+    C{name} on C{path} with the given arguments, or C{None} if there
+    is no cache or C{path} is not a regular file.
+    """
+    cache = getPolicyCache(policyObj.recipe)
+    if cache is None:
+        return None
+    destdir = policyObj.macros.destdir
+    fullpath = destdir + path
+    if not util.isregular(fullpath):
+        return None
+    return (policyObj.__class__.__name__, name,
+            cache.getSourceDigest(policyObj.__class__), destdir, path,
+            repr(args), repr(sorted(keywords.items())), hashFile(fullpath))
+
+
+def restoreCachedFile(policyObj, key, path):
+    """
+    Give C{path} the contents recorded under C{key} and report its
+    messages again; returns C{False} if there is nothing to restore.
+    """
+    recipe = policyObj.recipe
+    cache = getPolicyCache(recipe)
+    entry = cache.get(key)
+    if entry is None:
+        return False
+    inputDigest = key[-1]
+    outputDigest, messages = entry
+    if outputDigest != inputDigest and not cache.hasObject(outputDigest):
+        return False
+    cache.hits += 1
+    if outputDigest != inputDigest:
+        cache.restoreObject(outputDigest, policyObj.macros.destdir + path)
+        if path in recipe.magic:
+            del recipe.magic[path]
+    for name, messageArgs, messageKeywords in messages:
+        getattr(policyObj, name)(*messageArgs, **messageKeywords)
+    return True
+
+
+def storeCachedFile(policyObj, key, path, messages=()):
+    """
+    Record the contents a per-file method left at C{path}, and the
+    messages it reported, under C{key}.
+    """
+    cache = getPolicyCache(policyObj.recipe)
+    cache.misses += 1
+    fullpath = policyObj.macros.destdir + path
+    if not util.isregular(fullpath):
+        # renamed or removed; nothing to record
+        return
+    inputDigest = key[-1]
+    outputDigest = hashFile(fullpath)
+    if outputDigest != inputDigest:
+        cache.storeObject(fullpath, outputDigest)
+    cache.put(key, (outputDigest, list(messages)))
+
+
+def cachedFile(method):
+    """
+    Decorator for per-file methods, whose first argument after C{self}
+    is a path relative to the destdir, like C{doFile}, and whose only
+    effects are rewriting that file and reporting messages.  What it
+    does must depend on nothing but the file's contents, the destdir
+    and its arguments, since nothing else is part of the key.  When the
+    C{CONARY_POLICY_CACHE} environment variable names a directory, a
+    file whose contents the method has seen in an earlier cook of the
+    same package is given the contents the method produced then, and
+    its messages are reported again, without calling the method.
+    """
+    def wrapper(self, path, *args, **keywords):
+        key = getFileCacheKey(self, method.__name__, path, args, keywords)
+        if key is None:
+            return method(self, path, *args, **keywords)
+        if restoreCachedFile(self, key, path):
+            return None
+
+        messages = []
+        saved = _teeMessages(self, messages)
+        try:
+            result = method(self, path, *args, **keywords)
+        finally:
+            _restoreMessages(self, saved)
+        storeCachedFile(self, key, path, messages)
+        return result
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+# Per-policy profiling
+
+PROFILE_ENV = 'CONARY_POLICY_PROFILE'
+
+# Profiles of the policies currently running, innermost last.  This
+# is the only cook state kept outside the recipe, because util.execute
+# and util.popen have no way to find the recipe that called them.
+_activeProfiles = []
+# counts are also made from parallelMap worker threads
+if threading is not None:
+    _countLock = threading.Lock()
+else:
+    _countLock = None
+
+
+class _CountingDatabase(object):
+    """
+    Wraps a local database so that every method call is counted as a
+    database query against the policy that is currently running.
+    """
+
+    def __init__(self, db):
+        self._db = db
+
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **keywords):
+            _countActive('dbQueries')
+            return attr(*args, **keywords)
+        return call
+
+
+def _countActive(counter):
+    if _countLock is not None:
+        _countLock.acquire()
+    try:
+        if _activeProfiles:
+            _activeProfiles[-1][counter] += 1
+    finally:
+        if _countLock is not None:
+            _countLock.release()
+
+
+class _PolicyProfile(object):
+
+    def __init__(self, recipe, reportPath):
+        self.recipe = recipe
+        if os.path.isdir(reportPath):
+            reportPath = os.path.join(reportPath,
+                '%s-policy-profile.json' %recipe.name)
+        self.reportPath = reportPath
+        self.policies = []
+        self.policyMap = {}
+
+    def getStats(self, policyObj):
+        name = policyObj.__class__.__name__
+        stats = self.policyMap.get(name)
+        if stats is None:
+            stats = self.policyMap[name] = {
+                'name': name,
+                'module': policyObj.__class__.__module__,
+                'runs': 0,
+                'wallTime': 0.0,
+                'cpuTime': 0.0,
+                'childCpuTime': 0.0,
+                'filesVisited': 0,
+                'doFileCalls': 0,
+                'subprocesses': 0,
+                'dbQueries': 0,
+                '_paths': set(),
+            }
+            self.policies.append(stats)
+        return stats
+
+    def start(self, policyObj):
+        stats = self.getStats(policyObj)
+        if stats in _activeProfiles:
+            # a subclass calling its parent's doProcess
+            return None
+        stats['runs'] += 1
+        stats['_started'] = (time.time(), os.times())
+        _activeProfiles.append(stats)
+        return stats
+
+    def stop(self, stats):
+        if stats is None:
+            return
+        wallStart, timesStart = stats.pop('_started')
+        timesStop = os.times()
+        stats['wallTime'] += time.time() - wallStart
+        stats['cpuTime'] += ((timesStop[0] + timesStop[1]) -
+                             (timesStart[0] + timesStart[1]))
+        stats['childCpuTime'] += ((timesStop[2] + timesStop[3]) -
+                                  (timesStart[2] + timesStart[3]))
+        _activeProfiles.remove(stats)
+        self.writeReport()
+
+    def writeReport(self):
+        policies = []
+        for stats in self.policies:
+            stats['filesVisited'] = len(stats['_paths'])
+            policies.append(dict((x, y) for x, y in stats.iteritems()
+                                 if not x.startswith('_')))
+        report = {
+            'recipe': self.recipe.name,
+            'version': self.recipe.version,
+            'policies': policies,
+        }
+        lookup = getattr(self.recipe, '_policyPathLookup', None)
+        if lookup is not None:
+            report['pathLookup'] = lookup.getStats()
+        cache = getattr(self.recipe, '_policyCache', None)
+        if cache is not None:
+            report['cache'] = {'hits': cache.hits, 'misses': cache.misses}
+        report['databases'] = [
+            {'root': x.root, 'dbPath': x.dbPath, 'opens': x.opens}
+            for x in getattr(self.recipe, '_policyDatabases', {}).values()]
+
+        # rewritten after every policy, so that the report on disk is
+        # complete however the cook ends
+        tmpPath = self.reportPath + '.tmp'
+        f = open(tmpPath, 'w')
+        if json is not None:
+            json.dump(report, f, indent=2, sort_keys=True)
+        else:
+            f.write(repr(report))
+        f.write('\n')
+        f.close()
+        os.rename(tmpPath, self.reportPath)
+
+
+def _getProfile(recipe):
+    profile = getattr(recipe, '_policyProfile', None)
+    if profile is None:
+        profile = _PolicyProfile(recipe, os.environ[PROFILE_ENV])
+        recipe._policyProfile = profile
+    return profile
+
+
+def _profileDoProcess(method):
+    def doProcess(self, recipe):
+        profile = _getProfile(recipe)
+        stats = profile.start(self)
+        try:
+            return method(self, recipe)
+        finally:
+            profile.stop(stats)
+    doProcess._policyProfiled = True
+    return doProcess
+
+
+def _profilePerFile(method):
+    # counted against the policy that owns the method, which for
+    # pluggable policies is not the policy whose doProcess is running
+    def wrapper(self, path, *args, **keywords):
+        stats = _getProfile(self.recipe).getStats(self)
+        stats['doFileCalls'] += 1
+        stats['_paths'].add(path)
+        return method(self, path, *args, **keywords)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    wrapper._policyProfiled = True
+    return wrapper
+
+
+def _profileSubprocess(function):
+    def wrapper(*args, **keywords):
+        _countActive('subprocesses')
+        return function(*args, **keywords)
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    wrapper._policyProfiled = True
+    return wrapper
+
+
+def _isProfiled(method):
+    method = getattr(method, 'im_func', method)
+    return getattr(method, '_policyProfiled', False)
+
+
+def profilePolicies(namespace):
+    """
+    Instrument the policies defined in a policy module when the
+    C{CONARY_POLICY_PROFILE} environment variable names a report file
+    (or a directory to write C{<name>-policy-profile.json} into).
+    Each policy then records wall and CPU time, files visited, C{doFile}
+    calls, subprocesses started through C{util.execute} and
+    C{util.popen}, and local database queries; the report is written
+    as JSON after every policy run.  Does nothing otherwise.
+    """
+    if not os.environ.get(PROFILE_ENV):
+        return
+
+    for name in ('execute', 'popen'):
+        function = getattr(util, name)
+        if not _isProfiled(function):
+            setattr(util, name, _profileSubprocess(function))
+
+    for name, cls in namespace.items():
+        if not (name[:1].isupper()
+                and isinstance(cls, (type, types.ClassType))
+                and hasattr(cls, 'doProcess')):
+            continue
+        if not _isProfiled(cls.doProcess):
+            cls.doProcess = _profileDoProcess(cls.doProcess.im_func)
+        for methodName in ('doFile', 'addPluggableRequirements'):
+            method = getattr(cls, methodName, None)
+            if method is not None and not _isProfiled(method):
+                setattr(cls, methodName, _profilePerFile(method.im_func))
@@ -15,13 +15,18 @@
 #
 
 
+import imp
 import os
 import shutil
 import stat
+import sys
 
 from conary.build import policy, recipe
 from conary.lib import util
 
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
+
 
 class AutoDoc(policy.DestdirPolicy):
     """
@@ -110,3 +115,6 @@ class AutoDoc(policy.DestdirPolicy):
         os.chmod(dest, 0644)
         # this file should not be counted as making package non-empty
         self.recipe._autoCreatedFileCount += 1
+
+
+_policyutil.profilePolicies(globals())
@@ -15,12 +15,17 @@
 #
 
 
+import imp
 import os
 import stat
+import sys
 
 from conary.lib import util
 from conary.build import policy, recipe
 
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
+
 
 class NonBinariesInBindirs(policy.EnforcementPolicy):
     """
@@ -68,12 +73,11 @@ class NonBinariesInBindirs(policy.EnforcementPolicy):
         '%(sysconfdir)s/cron.monthly/',
     ]
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, filename):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(filename):
-                return
         d = self.macros['destdir']
-        mode = os.lstat(util.joinPaths(d, filename))[stat.ST_MODE]
+        mode = _policyutil.lstat(self.recipe,
+                                 util.joinPaths(d, filename))[stat.ST_MODE]
         if not mode & 0111:
             self.error(
                 "%s has mode 0%o with no executable permission in bindir",
@@ -119,10 +123,8 @@ class FilesInMandir(policy.EnforcementPolicy):
     ]
     recursive = False
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, filename):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(filename):
-                return
         self.error("%s is non-directory file in mandir", filename)
 
 
@@ -173,11 +175,8 @@ class FixupManpagePaths(policy.DestdirPolicy, FilesInMandir):
                 return False
         return True
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
-
         # heuristic parsing of a manpage filename to figure out its catagory
         mandir = self.recipe.macros.mandir
         d = self.recipe.macros.destdir
@@ -229,13 +228,11 @@ class BadInterpreterPaths(policy.EnforcementPolicy):
     processUnmodified = False
     invariantexceptions = [ '%(thisdocdir.literalRegex)s/', ]
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
-
         d = self.macros['destdir']
-        mode = os.lstat(util.joinPaths(d, path))[stat.ST_MODE]
+        mode = _policyutil.lstat(self.recipe,
+                                 util.joinPaths(d, path))[stat.ST_MODE]
         if not mode & 0111:
             # we care about interpreter paths only in executable scripts
             return
@@ -287,10 +284,8 @@ class ImproperlyShared(policy.EnforcementPolicy):
     processUnmodified = False
     invariantsubtrees = [ '/usr/share/' ]
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, filename):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(filename):
-                return
         m = self.recipe.magic[filename]
         if m:
             if m.name == "ELF":
@@ -353,10 +348,8 @@ class CheckDesktopFiles(policy.EnforcementPolicy):
                 self.iconDirs.append(iconDirs)
         policy.EnforcementPolicy.updateArgs(self, *args, **keywords)
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, filename):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(filename):
-                return
         self.iconDirs = [ x % self.macros for x in self.iconDirs ]
         self.checkIcon(filename)
 
@@ -429,11 +422,8 @@ class RequireChkconfig(policy.EnforcementPolicy):
     processUnmodified = False
     invariantsubtrees = [ '%(initdir)s' ]
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
-
         d = self.macros.destdir
         fullpath = util.joinPaths(d, path)
         if not (os.path.isfile(fullpath) and util.isregular(fullpath)):
@@ -457,3 +447,9 @@ class RequireChkconfig(policy.EnforcementPolicy):
                 break
         if not foundChkconfig:
             self.warn("initscript %s must contain chkconfig information before any uncommented lines", path)
+
+
+_policyutil.declareReadOnly(NonBinariesInBindirs, FilesInMandir,
+                            BadInterpreterPaths, ImproperlyShared,
+                            CheckDesktopFiles, RequireChkconfig)
+_policyutil.profilePolicies(globals())
@@ -15,13 +15,18 @@
 #
 
 
+import imp
 import os
 import re
 import stat
+import sys
 
 from conary.lib import magic, util
 from conary.build import policy, recipe
 
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
+
 
 class BadFilenames(policy.EnforcementPolicy):
     """
@@ -50,13 +55,10 @@ class BadFilenames(policy.EnforcementPolicy):
         assert(not self.exceptions)
         return True
 
+    # Capsules do not participate in protocols that forbid newlines
+    # in file names, such as tag handlers
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        # Capsules do not participate in protocols that forbid newlines
-        # in file names, such as tag handlers
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
-
         if path.find('\n') != -1:
             self.error("path %s has illegal newline character", path)
 
@@ -80,10 +82,8 @@ class NonUTF8Filenames(policy.EnforcementPolicy):
     UTF-8, as that is the standard encoding.
     """
     processUnmodified = True
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
         try:
             path.decode('utf-8')
         except UnicodeDecodeError:
@@ -140,10 +140,8 @@ class NonMultilibComponent(policy.EnforcementPolicy):
             return False
         return True
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
         if not False in self.reported.values():
             return
         # we've already matched effectively the same regex, so should match...
@@ -228,18 +226,16 @@ class CheckDestDir(policy.EnforcementPolicy):
     does not search inside files.
     """
     processUnmodified = False
+    @_policyutil.skipCapsuleFiles
     def doFile(self, filename):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(filename):
-                return
-
         d = self.macros.destdir
         b = self.macros.builddir
 
         if filename.find(d) != -1:
             self.error('Path %s contains destdir %s', filename, d)
         fullpath = d+filename
-        if os.path.islink(fullpath):
+        mode = _policyutil.lstat(self.recipe, fullpath)[stat.ST_MODE]
+        if stat.S_ISLNK(mode):
             contents = os.readlink(fullpath)
             if contents.find(d) != -1:
                 self.error('Symlink %s contains destdir %s in contents %s',
@@ -322,9 +318,8 @@ class FilesForDirectories(policy.EnforcementPolicy):
     def do(self):
         d = self.recipe.macros.destdir
         for path in self.candidates:
-            if hasattr(self.recipe, '_getCapsulePathsForFile'):
-                if self.recipe._getCapsulePathsForFile(path):
-                    break
+            if _policyutil.isCapsulePath(self.recipe, path):
+                break
             fullpath = util.joinPaths(d, path)
             if os.path.exists(fullpath):
                 if not os.path.isdir(fullpath):
@@ -479,10 +474,8 @@ class PythonEggs(policy.EnforcementPolicy):
         ('.*/python[^/]*/site-packages/.*\.egg', stat.S_IFREG),
     ]
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
         fullPath = util.joinPaths(self.recipe.macros.destdir, path)
         m = magic.magic(fullPath)
         if not (m and m.name == 'ZIP'):
@@ -491,3 +484,7 @@ class PythonEggs(policy.EnforcementPolicy):
             self.error('Python .egg %s exists; use'
                        ' --single-version-externally-managed argument'
                        ' to setup.py or use r.PythonSetup()', path)
+
+
+_policyutil.declareReadOnly(BadFilenames, NonUTF8Filenames, CheckDestDir)
+_policyutil.profilePolicies(globals())
@@ -15,9 +15,16 @@
 #
 
 
+import imp
+import os
+import sys
+
 from conary.build import policy, use
 from conary.deps import deps
 
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
+
 class RemoveBootstrapTroveDependencies(policy.PackagePolicy):
     filetree = policy.PACKAGE
     # must run after all policies that might add a trove: dependency
@@ -56,3 +63,6 @@ class RemoveBootstrapTroveDependencies(policy.PackagePolicy):
                     depSet.addDep(depClass, dep)
             if removed:
                 cmp.requires = depSet
+
+
+_policyutil.profilePolicies(globals())
@@ -15,14 +15,19 @@
 #
 
 
+import imp
 import itertools
 import os
+import sys
 
 from conary.build import packagepolicy
 from conary.deps import deps
 from conary.lib import util
 from conary.lib import fixedglob
 
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
+
 # copied from pkgconfig.py
 if hasattr(packagepolicy, '_basePluggableRequires'):
     _basePluggableRequires = packagepolicy._basePluggableRequires
@@ -157,3 +162,6 @@ class EggRequires(_basePluggableRequires):
             if troveName:
                 self._addRequirement(path, troveName, [], pkgFiles,
                                      deps.TroveDependencies)
+
+
+_policyutil.profilePolicies(globals())
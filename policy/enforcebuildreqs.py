@@ -15,17 +15,22 @@
 #
 
 
+import imp
 import itertools
 import os
 import re
 import stat
+import sys
+import types
 
 from conary.deps import deps
 from conary.lib import util, magic
-from conary.local import database
 from conary.build import policy
 from conary.build import use
 
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
+
 
 def _providesNames(libname):
     provideList = [libname]
@@ -161,8 +166,7 @@ class _enforceBuildRequirements(_warnBuildRequirements):
 
         self._initComponentExceptions()
 
-        cfg = self.recipe.cfg
-        self.db = database.Database(cfg.root, cfg.dbPath)
+        self.db = _policyutil.openDatabase(self.recipe)
         self.systemProvides = self.db.getTrovesWithProvides(depSetList)
         self.unprovided = [x for x in depSetList if x not in self.systemProvides]
 
@@ -186,39 +190,61 @@ class _enforceBuildRequirements(_warnBuildRequirements):
     def postProcess(self):
         del self.db
 
-    def do(self):
-        missingBuildRequiresChoices = []
+    def _skipPath(self, path):
+        if (hasattr(self.recipe, '_isDerived')
+            and self.recipe._isDerived == True
+            and self.processUnmodified is False
+            and path in self.recipe._derivedFiles
+            and not self.mtimeChanged(path)):
+            # ignore this file
+            return True
+        if (self.ignoreCapsuleFiles
+            and _policyutil.isCapsulePath(self.recipe, path)):
+            return True
+        return False
 
-        components = self.recipe.autopkg.components
+    def _indexPathMap(self):
+        # Walk the pathMap exactly once, building an inverted index
+        # from dependency name to the paths that require it, so that
+        # finding the files responsible for a dependency is a lookup
+        # rather than another walk over every file in the package
         pathMap = self.recipe.autopkg.pathMap
-        pathReqMap = {}
-        interpreterSet = set()
-
+        depPathMap = {}
         interpreterMap = {}
         for path in pathMap:
-            if (hasattr(self.recipe, '_isDerived')
-                and self.recipe._isDerived == True
-                and self.processUnmodified is False
-                and path in self.recipe._derivedFiles
-                and not self.mtimeChanged(path)):
-                # ignore this file
+            if self._skipPath(path):
                 continue
-            if self.ignoreCapsuleFiles and hasattr(self.recipe,
-                                              '_getCapsulePathsForFile'):
-                if self.recipe._getCapsulePathsForFile(path):
-                    continue
             pkgfile = pathMap[path]
-            if pkgfile.hasContents:
-                m = self.recipe.magic[path]
-                if isinstance(m, magic.script):
-                    interpreter = m.contents['interpreter']
-                    if interpreter:
-                        interpreterMap[path] = (pkgfile.requires(), interpreter)
+            if not pkgfile.hasContents:
+                continue
+            for dep in pkgfile.requires().iterDepsByClass(self.depClass):
+                depPathMap.setdefault(dep.name, []).append(path)
+            m = self.recipe.magic[path]
+            if isinstance(m, magic.script):
+                interpreter = m.contents['interpreter']
+                if interpreter:
+                    interpreterMap[path] = interpreter
+        return depPathMap, interpreterMap
+
+    def _pathsRequiring(self, depPathMap, depSet):
+        paths = set()
+        for dep in depSet.iterDepsByClass(self.depClass):
+            paths.update(depPathMap.get(dep.name, ()))
+        return paths
+
+    def do(self):
+        missingBuildRequiresChoices = []
+
+        pathReqMap = {}
+        interpreterSet = set()
+
+        depPathMap, interpreterMap = self._indexPathMap()
 
         provideNameMap = dict([(x[0], x) for x in
                                itertools.chain(*self.systemProvides.values())])
 
         for dep in self.systemProvides:
+            depPaths = self._pathsRequiring(depPathMap, dep)
             provideNameList = [x[0] for x in self.systemProvides[dep]]
             # normally, there is only one name in provideNameList
 
@@ -256,41 +282,26 @@ class _enforceBuildRequirements(_warnBuildRequirements):
 
                 # Now give lots of specific information to help the packager
                 # in case things do not look so obvious...
-                pathList = []
-                for path in pathMap:
-                    if (hasattr(self.recipe, '_isDerived')
-                        and self.recipe._isDerived == True
-                        and self.processUnmodified is False
-                        and path in self.recipe._derivedFiles
-                        and not self.mtimeChanged(path)):
-                        # ignore this file
-                        continue
-                    if self.ignoreCapsuleFiles and hasattr(self.recipe,
-                                                  '_getCapsulePathsForFile'):
-                        if self.recipe._getCapsulePathsForFile(path):
-                            continue
-                    pkgfile = pathMap[path]
-                    if pkgfile.hasContents and (pkgfile.requires() & dep):
-                        pathList.append(path)
-                        l = pathReqMap.setdefault(path, [])
-                        l.append(dep)
-                if pathList:
+                for path in depPaths:
+                    l = pathReqMap.setdefault(path, [])
+                    l.append(dep)
+                if depPaths:
                     self.warn('buildRequires %s needed to satisfy "%s"'
                               ' for files: %s',
                               str(sorted(list(foundCandidates))),
                               str(dep),
-                              ', '.join(sorted(pathList)))
+                              ', '.join(sorted(depPaths)))
 
             # look for interpreters
-            if path in interpreterMap:
-                requires, interpreter = interpreterMap[path]
-                if requires & dep:
-                    interpreterSet.add(interpreter)
+            interpreterSet.update(interpreterMap[path]
+                                  for path in depPaths
+                                  if path in interpreterMap)
 
         if interpreterSet:
             # find their components and add them to the list
+            lookup = _policyutil.getPathLookup(self.recipe)
             for interpreter in interpreterSet:
-                for trove in self.db.iterTrovesByPath(interpreter):
+                for trove in lookup.iterTrovesByPath(interpreter):
                     interpreterTroveName = trove.getName()
                     if interpreterTroveName not in self.transitiveBuildRequires:
                         self.talk('interpreter %s missing build requirement %s',
@@ -532,6 +543,36 @@ class EnforcePerlBuildRequirements(_enforceBuildRequirements):
     ignoreCapsuleFiles = False
 
 
+class _RecipeCallRecorder(object):
+    """
+    Stands in for the recipe while a log is scanned in a worker
+    process.  Calls to policies, such as
+    C{r.EnforceStaticLibBuildRequirements()}, are recorded to be made
+    again on the real recipe; anything else is read from the recipe.
+    """
+
+    def __init__(self, recipe):
+        self._recipe = recipe
+        self.calls = []
+
+    def __getattr__(self, name):
+        attr = getattr(self._recipe, name)
+        if not name[:1].isupper() or not callable(attr):
+            return attr
+        def call(*args, **keywords):
+            # the calls are pickled, so generators become lists
+            args = [self._materialize(x) for x in args]
+            keywords = dict((x, self._materialize(y))
+                            for x, y in keywords.iteritems())
+            self.calls.append((name, args, keywords))
+        return call
+
+    def _materialize(self, value):
+        if isinstance(value, types.GeneratorType):
+            return list(value)
+        return value
+
+
 class _enforceLogRequirements(policy.EnforcementPolicy):
     """
     Abstract base class
@@ -552,11 +593,16 @@ class _enforceLogRequirements(policy.EnforcementPolicy):
     # Regexp to search dependencies
     foundRe = ''
 
+    # numbered back references and conditional groups
+    groupReferenceRe = re.compile(r'\\[1-9]|\(\?\(')
+
     def test(self):
         if self.recipe.ignoreDeps:
             return False
 
         self.foundPaths = set()
+        self.logPaths = []
+        self.jobs = _policyutil.getJobCount(self.recipe)
         self.greydict = {}
         # interpolate macros, compile regexps
         macros = self.macros
@@ -569,6 +615,23 @@ class _enforceLogRequirements(policy.EnforcementPolicy):
                                re.compile(startRe%macros),
                                re.compile(stopRe%macros)))
         self.stanzaList = stanzaList
+        # one expression that matches wherever foundRe or any start or
+        # stop expression does, so that most lines are rejected by a
+        # single match
+        expressions = [x for x in
+                       [self.foundRe] + [y[1] for y in stanzaList] +
+                       [y[2] for y in stanzaList] if x]
+        self.candidateRe = None
+        if not [x for x in expressions
+                if x.flags or self.groupReferenceRe.search(x.pattern)]:
+            # numbered group references would refer to the wrong
+            # groups once combined, and flags would be lost
+            try:
+                self.candidateRe = re.compile('|'.join(
+                    ['(?:%s)' %x.pattern for x in expressions]))
+            except re.error:
+                # for instance, two define the same named group
+                pass
 
         # process exceptions differently; user can specify either the
         # source (found path) or destination (found component) to ignore
@@ -598,6 +661,28 @@ class _enforceLogRequirements(policy.EnforcementPolicy):
 
 
     def doFile(self, path):
+        if self.jobs > 1:
+            # with more than one job, postProcess scans the logs
+            # together in worker processes
+            self.logPaths.append(path)
+        else:
+            self._parseLog(path)
+
+    def _scanLog(self, path):
+        # runs in a worker process: returns what parsing the log
+        # added to foundPaths and the policy calls it made
+        foundPaths = self.foundPaths
+        recipe = self.recipe
+        self.foundPaths = set()
+        self.recipe = _RecipeCallRecorder(recipe)
+        try:
+            self._parseLog(path)
+            return self.foundPaths, self.recipe.calls
+        finally:
+            self.foundPaths = foundPaths
+            self.recipe = recipe
+
+    def _parseLog(self, path):
 
         fullpath = self.macros.builddir + path
 
@@ -614,16 +699,18 @@ class _enforceLogRequirements(policy.EnforcementPolicy):
         # just represent paths that are known to have to exist;
         # it's just faster to process the file once instead of twice.
 
-        def foundStanzaStart(line):
-            for handler, startRe, stopRe in self.stanzaList:
-                match = startRe.match(line)
-                if match:
-                    yield handler, stopRe, match.groups(), 
-
         def iterConfigStanzas(lines, fullpath):
             openStanzas = {}
             openStanzaLines = {}
-            for line in (x.rstrip('\n') for x in lines):
+            isCandidate = self.candidateRe and self.candidateRe.match
+            for line in lines:
+
+                # every line belongs to the stanzas already open
+                for stanzaLines in openStanzaLines.itervalues():
+                    stanzaLines.append(line)
+                if isCandidate and not isCandidate(line):
+                    # matches no expression below
+                    continue
 
                 # the trivial case of the known-needed path on one line
                 foundPath = self.foundPath(line)
@@ -634,15 +721,18 @@ class _enforceLogRequirements(policy.EnforcementPolicy):
                 # the start and stop regexp are the same, you return
                 # the lines of the file segmented by that regexp
                 for handler in openStanzas.keys(): # not iterkeys()
-                    openStanzaLines[handler].append(line)
                     stopRe, startGroups = openStanzas[handler]
                     match = stopRe.match(line)
                     if match:
                         openStanzas.pop(handler)
                         handler(startGroups, match.groups(),
-                                openStanzaLines[handler], fullpath)
+                                openStanzaLines.pop(handler), fullpath)
 
-                for handler, stopRe, startGroups in foundStanzaStart(line):
+                for handler, startRe, stopRe in self.stanzaList:
+                    match = startRe.match(line)
+                    if not match:
+                        continue
+                    startGroups = match.groups()
                     if handler in openStanzas:
                         # report partial stanza
                         handler(startGroups, None, openStanzaLines[handler],
@@ -661,9 +751,13 @@ class _enforceLogRequirements(policy.EnforcementPolicy):
 
         # iterator to avoid reading in the whole file at once;
         # nested iterators to avoid matching regexp twice
-        foundPaths = set(path for path in iterConfigStanzas(
-                            file(fullpath), fullpath)
-                         if path not in self.pathExceptions)
+        f = file(fullpath)
+        try:
+            foundPaths = set(path for path in iterConfigStanzas(
+                                (x.rstrip('\n') for x in f), fullpath)
+                             if path not in self.pathExceptions)
+        finally:
+            f.close()
 
         # now remove false positives using the greylist
         if self.greydict:
@@ -672,10 +766,20 @@ class _enforceLogRequirements(policy.EnforcementPolicy):
         self.foundPaths.update(foundPaths)
 
     def postProcess(self):
+        # merge in path order, so that the outcome does not depend on
+        # which worker finished first
+        logPaths = sorted(self.logPaths)
+        self.logPaths = []
+        for foundPaths, calls in _policyutil.processMap(
+                self._scanLog, logPaths, self.jobs):
+            self.foundPaths.update(foundPaths)
+            for name, args, keywords in calls:
+                getattr(self.recipe, name)(*args, **keywords)
+
         if not self.foundPaths:
             return
 
-        db = database.Database(self.recipe.cfg.root, self.recipe.cfg.dbPath)
+        db = _policyutil.openDatabase(self.recipe)
 
         # first, get all the trove names in the transitive buildRequires
         # runtime dependency closure
@@ -684,9 +788,11 @@ class _enforceLogRequirements(policy.EnforcementPolicy):
         # next, for each file found, report if it is not in the
         # transitive closure of runtime requirements of buildRequires
         fileReqs = set()
+        pathTroves = _policyutil.getPathLookup(
+            self.recipe).getTrovesByPaths(self.foundPaths)
         for path in sorted(self.foundPaths):
             for pathReq in set(trove.getName()
-                               for trove in db.iterTrovesByPath(path)):
+                               for trove in pathTroves[path]):
                 pathReqCandidates = _providesNames(pathReq)
                 # remove any recursive or non-existing buildreqs
                 pathReqCandidates = [x for x in pathReqCandidates 
@@ -925,18 +1031,14 @@ class EnforceFlagBuildRequirements(_warnBuildRequirements):
         except AttributeError:
             return False
 
-        cfg = self.recipe.cfg
-        self.db = database.Database(cfg.root, cfg.dbPath)
         self.setTalk()
 
         return True
 
-    def postProcess(self):
-        del self.db
-
     def do(self):
         missingBuildRequires = set()
         foundBuildRequires = set()
+        lookup = _policyutil.getPathLookup(self.recipe)
         for flag in use.iterUsed():
             if (hasattr(self.recipe, '_isDerived')
                 and self.recipe._isDerived == True):
@@ -947,7 +1049,7 @@ class EnforceFlagBuildRequirements(_warnBuildRequirements):
                             if flag.name in dep[1].flags:
                                 continue
             path = flag._path
-            for trove in self.db.iterTrovesByPath(path):
+            for trove in lookup.iterTrovesByPath(path):
                 flagTroveName = trove.getName()
                 if flagTroveName in self.transitiveBuildRequires:
                     foundBuildRequires.add(flagTroveName)
@@ -1057,7 +1159,7 @@ class EnforceStaticLibBuildRequirements(_warnBuildRequirements):
         # case of static linking outside of the package being built.
         transitiveBuildRequires = self.transitiveBuildRequires.union(self.warnedSoNames)
         cfg = self.recipe.cfg
-        db = database.Database(cfg.root, cfg.dbPath)
+        db = _policyutil.openDatabase(self.recipe)
 
         foundLibNames = set()
         allPossibleProviders = set()
@@ -1103,11 +1205,14 @@ class EnforceStaticLibBuildRequirements(_warnBuildRequirements):
             for logLine in self.logLines:
                 yield logLine.split()
 
+        lookup = _policyutil.getPathLookup(self.recipe)
+
         def pathSetToTroveSet(pathSet):
             troveSet = set()
+            pathTroves = lookup.getTrovesByPaths(pathSet)
             for path in pathSet:
                 for pathReq in set(trove.getName()
-                                   for trove in db.iterTrovesByPath(path)):
+                                   for trove in pathTroves[path]):
                     pathReqCandidates = _providesNames(pathReq)
                     # remove any recursive or non-existing buildreqs
                     pathReqCandidates = [x for x in pathReqCandidates 
@@ -1297,3 +1402,6 @@ class EnforceLocalizationBuildRequirements(_warnBuildRequirements):
             self.warn('missing buildRequires %s for file %s',
                       str(sorted(list(missingReqs))), path[1:])
             reportMissingBuildRequires(self.recipe, missingReqs)
+
+
+_policyutil.profilePolicies(globals())
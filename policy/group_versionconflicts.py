@@ -15,8 +15,15 @@
 #
 
 
+import imp
+import os
+import sys
+
 from conary.build import policy
 
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
+
 # copied from pkgconfig.py
 if hasattr(policy, 'ImageGroupEnforcementPolicy'):
     _ImageGroupEnforcementPolicy = policy.ImageGroupEnforcementPolicy
@@ -122,3 +129,6 @@ class VersionConflicts(_ImageGroupEnforcementPolicy):
             errorMessage = "Multiple versions of these troves were found:"
             errorMessage += '\n' + '\n'.join(sorted(allTroves))
             self.recipe.reportErrors(errorMessage)
+
+
+_policyutil.profilePolicies(globals())
@@ -15,9 +15,16 @@
 #
 
 
+import imp
+import os
+import sys
+
 from conary.build import packagepolicy
 from conary.deps import deps
 
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
+
 if hasattr(packagepolicy, '_basePluggableRequires'):
     _basePluggableRequires = packagepolicy._basePluggableRequires
 else:
@@ -81,3 +88,6 @@ class HttpdConfigRequires(_basePluggableRequires):
 
         self._addRequirement(path, "/usr/sbin/httpd", [], pkgFiles,
                              deps.FileDependencies)
+
+
+_policyutil.profilePolicies(globals())
@@ -15,11 +15,17 @@
 #
 
 
+import imp
+import os
 import re
+import sys
 import types
 
 from conary.build import policy
 
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
+
 class TagLocale(policy.PackagePolicy):
     """
     NAME
@@ -99,13 +105,10 @@ class TagLocale(policy.PackagePolicy):
             self.addLocaleExpression(localeExp)
         policy.PackagePolicy.updateArgs(self, *args, **keywords)
 
+    # even if a capsule were called :locale we still could
+    # not do locale filtering on it
+    @_policyutil.skipCapsuleFiles
     def doFile(self, filename):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(filename):
-                # even if a capsule were called :locale we still could
-                # not do locale filtering on it
-                return
-
         for localeExp in self.localeExpressions:
             m = localeExp.match(filename)
             if m is not None:
@@ -131,3 +134,6 @@ class TagLocale(policy.PackagePolicy):
             return
         f = pkg.getFile(filename)
         f.tags.set('locale(%s)' %locale)
+
+
+_policyutil.profilePolicies(globals())
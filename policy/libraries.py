@@ -15,12 +15,16 @@
 #
 
 
+import imp
 import os
 import stat
+import sys
 
 from conary.lib import util
 from conary.build import policy, recipe
-from conary.local import database
+
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
 
 
 # probably needs to migrate to some form of configuration
@@ -73,8 +77,8 @@ class AutoSharedLibrary(policy.DestdirPolicy):
     )
 
     def _managedFile(self, path):
-        db = database.Database(self.recipe.cfg.root, self.recipe.cfg.dbPath)
-        return bool(db.iterTrovesByPath(path))
+        lookup = _policyutil.getPathLookup(self.recipe)
+        return bool(lookup.iterTrovesByPath(path))
 
     def _iterSharedlibList(self):
         destdir = self.recipe.macros.destdir
@@ -236,11 +240,8 @@ class SharedLibrary(policy.PackagePolicy):
             self.recipe.Provides(**d)
             self.recipe.Requires(**d)
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, filename):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(filename):
-                return
-
         fullpath = self.macros.destdir + filename
         if os.path.isfile(fullpath) and util.isregular(fullpath):
             m = self.recipe.magic[filename]
@@ -302,11 +303,8 @@ class FixupMultilibPaths(policy.DestdirPolicy):
             self.dirmap[d %self.macros] = self.dirmap[d] %self.macros
         return True
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
-
         destdir = self.macros.destdir
         fullpath = util.joinPaths(destdir, path)
         mode = os.lstat(fullpath)[stat.ST_MODE]
@@ -427,15 +425,12 @@ class ExecutableLibraries(policy.DestdirPolicy):
     ]
     recursive = False
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
-
         fullpath = util.joinPaths(self.macros['destdir'], path)
-        if not util.isregular(fullpath):
-            return
         mode = os.lstat(fullpath)[stat.ST_MODE]
+        if not stat.S_ISREG(mode):
+            return
         if mode & 0111:
             # has some executable bit set
             return
@@ -483,11 +478,8 @@ class CheckSonames(policy.EnforcementPolicy):
     recursive = False
     nonSymlinkWarn = set()
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
-
         d = self.macros.destdir
         destlen = len(d)
         l = util.joinPaths(d, path)
@@ -596,10 +588,8 @@ class NormalizeLibrarySymlinks(policy.DestdirPolicy):
             util.execute('%s -n %s' %(ldConfigPath, fullpath))
 
             if not bootStrapLdConfig:
-                db = database.Database(self.recipe.cfg.root,
-                                       self.recipe.cfg.dbPath)
-                ldConfigTroveName = [ x.getName() for x in
-                                      db.iterTrovesByPath(ldConfigPath) ]
+                lookup = _policyutil.getPathLookup(self.recipe)
+                ldConfigTroveName = lookup.getTroveNamesByPath(ldConfigPath)
                 if ldConfigTroveName:
                     ldConfigTroveName = ldConfigTroveName[0]
                 else:
@@ -626,3 +616,6 @@ class NormalizeLibrarySymlinks(policy.DestdirPolicy):
             if removedfiles:
                 self.warn('ldconfig removed files in %s: %s', path,
                           ', '.join(sorted(list(removedfiles))))
+
+
+_policyutil.profilePolicies(globals())
@@ -15,11 +15,16 @@
 #
 
 
+import imp
 import os
+import sys
 
 from conary.lib import util
 from conary.build import policy
 
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
+
 
 class ParseManifest(policy.PackagePolicy):
     """
@@ -115,3 +120,6 @@ class ParseManifest(policy.PackagePolicy):
                 if owner != 'root' or group != 'root':
                     self.recipe.Ownership(owner, group,
                                           util.literalRegex(target))
+
+
+_policyutil.profilePolicies(globals())
@@ -15,8 +15,15 @@
 #
 
 
+import imp
+import os
+import sys
+
 from conary.build import policy
 
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
+
 class _BaseMetadata(policy.PackagePolicy):
     keywords = {
         'language'      : None,
@@ -247,3 +254,6 @@ class ResetKeyValueMetadata(policy.PackagePolicy):
             # Policy not invoked
             return
         self.recipe._filteredKeyValueMetadata.update(self._filteredKeyValues)
+
+
+_policyutil.profilePolicies(globals())
@@ -15,9 +15,16 @@
 #
 
 
+import imp
+import os
+import sys
+
 from conary.lib import util
 from conary.build import policy, recipe
 
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
+
 
 class RemoveNonPackageFiles(policy.DestdirPolicy):
     """
@@ -81,9 +88,10 @@ class RemoveNonPackageFiles(policy.DestdirPolicy):
                 return False
         return True
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
         self.info("Removing %s", path)
         util.remove(self.macros['destdir']+path, quiet=True)
+
+
+_policyutil.profilePolicies(globals())
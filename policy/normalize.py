@@ -15,48 +15,321 @@
 #
 
 
+import codecs
+import errno
+import imp
 import os
 import re
+import shutil
 import stat
+import sys
+import struct
 import tempfile
-import filecmp
-import shutil
+import time
+import zipfile
+import zlib
 
-from conary.lib import magic, util
+try:
+    import bz2
+except ImportError:
+    # python built without bz2 support
+    bz2 = None
+
+from conary.lib import util
 from conary.build import policy, recipe
-from conary.local import database
+
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
+
+
+# In-process (de)compression.  Results must match the external tools
+# byte for byte.  bz2 is the same libbz2 that bzip2 uses, so bzip2
+# files are recompressed entirely in process; zlib's deflate does not
+# always produce what gzip's does, so gzip files are decompressed in
+# process and compressed by gzip itself, many files per command.
+
+_blockSize = 1024 * 1024
+_gzipBatchSize = 256
+
+
+class _DecompressError(Exception):
+    pass
+
+
+def _gzipDecompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def _gzipEnded(decompressor):
+    # python 2 zlib objects do not say whether the stream is
+    # complete, but anything fed to a complete one is left unused
+    try:
+        decompressor.decompress('\0')
+    except zlib.error:
+        return False
+    return bool(decompressor.unused_data)
+
+
+def _bzipDecompressor():
+    return bz2.BZ2Decompressor()
+
+
+def _bzipEnded(decompressor):
+    # a complete bz2 stream refuses more input
+    try:
+        decompressor.decompress('\0')
+    except EOFError:
+        return True
+    except IOError:
+        pass
+    return False
+
+
+_decompressors = {
+    'gzip': (_gzipDecompressor, _gzipEnded),
+    'bzip': (_bzipDecompressor, _bzipEnded),
+}
+
+
+def _decompressFile(path, write, kind):
+    """
+    Pass the decompressed contents of C{path}, which may be several
+    concatenated streams, to C{write}.  Raises L{_DecompressError} for
+    a corrupt, truncated or padded file, which the external tool
+    may handle differently.
+    """
+    newDecompressor, ended = _decompressors[kind]
+    f = open(path, 'rb')
+    try:
+        decompressor = newDecompressor()
+        try:
+            while True:
+                data = f.read(_blockSize)
+                if not data:
+                    break
+                while data:
+                    try:
+                        write(decompressor.decompress(data))
+                    except EOFError:
+                        # the previous block ended a bz2 stream exactly
+                        decompressor = newDecompressor()
+                        continue
+                    data = decompressor.unused_data
+                    if data:
+                        # another stream follows
+                        decompressor = newDecompressor()
+            if not ended(decompressor):
+                raise _DecompressError(path)
+        except (zlib.error, IOError, EOFError):
+            raise _DecompressError(path)
+    finally:
+        f.close()
 
 
-def _findProgPath(prog, db, recipe):
-    # ignore arguments
-    prog = prog.split(' ')[0]
-    if prog.startswith('/'):
-        progPath = prog
+def _compressionType(path):
+    """
+    Return C{(kind, normalized)} for the file at C{path}, reading only
+    its header: C{kind} is C{'gzip'}, C{'bzip'} or C{None} if it is not
+    compressed, and C{normalized} is whether it was compressed at
+    maximum compression without recording its original name.
+    """
+    f = open(path, 'rb')
+    try:
+        header = f.read(10)
+    finally:
+        f.close()
+    if len(header) == 10 and header[0:2] == '\x1f\x8b':
+        # FLG.FNAME, and XFL is 2 for maximum compression
+        return 'gzip', not ord(header[3]) & 0x08 and header[8] == '\x02'
+    elif len(header) >= 4 and header[0:3] == 'BZh':
+        # block size in hundreds of kilobytes
+        return 'bzip', header[3] == '9'
+    return None, False
+
+
+def _uncompressFile(path):
+    """
+    Replace C{path}, named C{.gz} or C{.bz2}, with its uncompressed
+    contents as gunzip or bunzip2 would, and return the new path, or
+    C{None} if it has to be left to those tools.
+    """
+    if path.endswith('.gz'):
+        kind = 'gzip'
+        newPath = path[:-3]
+    elif path.endswith('.bz2') and bz2 is not None:
+        kind = 'bzip'
+        newPath = path[:-4]
     else:
-        macros = recipe.macros
-        searchPath = [macros.essentialbindir,
-                      macros.bindir,
-                      macros.essentialsbindir,
-                      macros.sbindir]
-        searchPath.extend([x for x in ['/bin', '/usr/bin', '/sbin', '/usr/sbin']
-                           if x not in searchPath])
-        searchPath.extend([x for x in os.getenv('PATH', '').split(os.path.pathsep)
-                           if x not in searchPath])
-        progPath = util.findFile(prog, searchPath)
-
-    progTroveName =  [ x.getName() for x in db.iterTrovesByPath(progPath) ]
-    if progTroveName:
-        progTroveName = progTroveName[0]
+        return None
+    try:
+        # created exclusively, since another worker may be
+        # uncompressing foo.gz and foo.bz2 into the same foo
+        fd = os.open(newPath, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0644)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+        # let the external tool complain
+        return None
+    f = os.fdopen(fd, 'wb')
+    try:
         try:
-            if progTroveName in recipe._getTransitiveBuildRequiresNames():
-                recipe.reportExcessBuildRequires(progTroveName)
-            else:
-                recipe.reportMisingBuildRequires(progTroveName)
-        except AttributeError:
-            # older conary
-            pass
+            _decompressFile(path, f.write, kind)
+        finally:
+            f.close()
+    except _DecompressError:
+        os.unlink(newPath)
+        return None
+    # keep the mode and times, as gunzip and bunzip2 do
+    st = os.lstat(path)
+    os.chmod(newPath, stat.S_IMODE(st.st_mode))
+    os.utime(newPath, (st.st_atime, st.st_mtime))
+    os.unlink(path)
+    return newPath
 
-    return progPath
+
+def _gzipFiles(gzip, paths, jobs):
+    """
+    Compress each of C{paths} in place with C{gzip -f -n -9}, many
+    paths to a command and up to C{jobs} commands at a time.
+    """
+    commands = []
+    for i in range(0, len(paths), _gzipBatchSize):
+        commands.append('%s -f -n -9 %s'
+                        %(gzip, ' '.join(paths[i:i+_gzipBatchSize])))
+    _policyutil.parallelMap(util.execute, commands, jobs)
+
+
+class _StreamReplacer(object):
+    """
+    Removes every occurrence of C{pattern} from data fed to it in
+    pieces, with the same result as C{data.replace(pattern, '')} on
+    the data as a whole.
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.pending = ''
+
+    def feed(self, data):
+        data = self.pending + data
+        pieces = []
+        start = 0
+        while True:
+            index = data.find(self.pattern, start)
+            if index == -1:
+                break
+            pieces.append(data[start:index])
+            start = index + len(self.pattern)
+        # a match could still begin in the last len(pattern)-1 bytes
+        keep = max(start, len(data) - len(self.pattern) + 1)
+        pieces.append(data[start:keep])
+        self.pending = data[keep:]
+        return ''.join(pieces)
+
+    def flush(self):
+        data = self.pending
+        self.pending = ''
+        return data
+
+
+def _moveTail(f, start, newStart):
+    # moves the contents of f from start onwards to begin at newStart
+    # instead, a block at a time, without leaving the file
+    size = os.fstat(f.fileno()).st_size
+    delta = newStart - start
+    if delta < 0:
+        # shrinking: copy forwards
+        pos = start
+        while pos < size:
+            f.seek(pos)
+            data = f.read(_blockSize)
+            f.seek(pos + delta)
+            f.write(data)
+            pos += len(data)
+        f.truncate(size + delta)
+    elif delta > 0:
+        # growing: copy backwards so nothing is overwritten unread
+        end = size
+        while end > start:
+            pos = max(start, end - _blockSize)
+            f.seek(pos)
+            data = f.read(end - pos)
+            f.seek(pos + delta)
+            f.write(data)
+            end = pos
+
+
+def _replaceFirstLine(path, replace):
+    """
+    Replace the first line of the file at C{path} with
+    C{replace(line)}.  The file is changed in place, keeping its inode
+    and so its hard links; the rest of the file is only moved, and
+    only if the length of the first line changed.
+    """
+    mode = os.lstat(path)[stat.ST_MODE]
+    # we need to be able to write the file
+    os.chmod(path, mode | 0600)
+    f = file(path, 'r+b')
+    try:
+        line = f.readline()
+        newLine = replace(line)
+        if newLine != line:
+            _moveTail(f, len(line), len(newLine))
+            f.seek(0)
+            f.write(newLine)
+    finally:
+        f.close()
+    # revert any change to mode
+    os.chmod(path, mode)
+
+
+def _rewriteLines(path, transform):
+    """
+    Apply C{transform} to each line of the file at C{path}.  The file
+    is read a line at a time, and only rewritten, in place, if some
+    line changes; returns whether it was.  C{transform} is called
+    more than once for the same line.
+    """
+    f = file(path)
+    try:
+        for line in f:
+            if transform(line) != line:
+                break
+        else:
+            return False
+    finally:
+        f.close()
+
+    mode = os.lstat(path)[stat.ST_MODE]
+    if not mode & 0200:
+        os.chmod(path, mode | 0200)
+    tmp = tempfile.TemporaryFile()
+    try:
+        f = file(path, 'r+')
+        try:
+            for line in f:
+                tmp.write(transform(line))
+            tmp.seek(0)
+            f.seek(0)
+            f.truncate(0) # we may have shrunk the file, avoid garbage
+            shutil.copyfileobj(tmp, f, _blockSize)
+        finally:
+            f.close()
+    finally:
+        tmp.close()
+    os.chmod(path, mode)
+    return True
+
+
+class _CompressionJob(object):
+
+    def __init__(self, path, fullpath, kind, cacheKey):
+        self.path = path
+        self.fullpath = fullpath
+        self.kind = kind
+        self.cacheKey = cacheKey
+        # recompressed contents, once ready
+        self.tmppath = None
 
 
 class NormalizeCompression(policy.DestdirPolicy):
@@ -99,54 +372,115 @@ class NormalizeCompression(policy.DestdirPolicy):
     invariantinclusions = [
         ('.*\.(gz|bz2)', None, stat.S_IFDIR),
     ]
-    db = None
     gzip = None
     bzip = None
 
-    def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
-        m = self.recipe.magic[path]
-        if not m:
-            return
-
-        # Note: uses external gzip/bunzip if they exist because a
-        # pipeline is faster in a multiprocessing environment
-
-        def _mktmp(fullpath):
-            fd, path = tempfile.mkstemp('.temp', '', os.path.dirname(fullpath))
-            os.close(fd)
-            return path
-
-        def _move(tmppath, fullpath):
-            os.chmod(tmppath, os.lstat(fullpath).st_mode)
-            os.rename(tmppath, fullpath)
+    def preProcess(self):
+        # doFile collects the files, and postProcess reads their
+        # headers and recompresses the ones that need it together,
+        # without building magic for them
+        self.jobs = _policyutil.getJobCount(self.recipe)
+        self.compressionPaths = []
 
-        def _findProg(prog):
-            if not self.db:
-                self.db = database.Database(self.recipe.cfg.root,
-                                       self.recipe.cfg.dbPath)
-            return _findProgPath(prog, self.db, self.recipe)
+    @_policyutil.skipCapsuleFiles
+    def doFile(self, path):
+        self.compressionPaths.append(path)
 
+    def _classify(self, path):
+        # may run in a worker thread
         fullpath = self.macros.destdir+path
-        if m.name == 'gzip' and \
-           (m.contents['compression'] != '9' or 'name' in m.contents):
-            tmppath = _mktmp(fullpath)
+        if not util.isregular(fullpath):
+            return None
+        kind, normalized = _compressionType(fullpath)
+        if normalized:
+            return None
+        return kind
+
+    def postProcess(self):
+        paths = self.compressionPaths
+        self.compressionPaths = []
+        kinds = _policyutil.parallelMap(self._classify, paths, self.jobs)
+        jobs = []
+        for path, kind in zip(paths, kinds):
+            if kind is None:
+                continue
+            key = _policyutil.getFileCacheKey(self, 'doFile', path)
+            if (key is not None
+                and _policyutil.restoreCachedFile(self, key, path)):
+                # look up the program recompressing would have run,
+                # so that buildRequires are reported the same way
+                if kind == 'gzip':
+                    self._findProg('gzip')
+                elif bz2 is None:
+                    self._findProg('bzip2')
+                continue
+            jobs.append(_CompressionJob(
+                path, self.macros.destdir+path, kind, key))
+        _policyutil.parallelMap(self._recompress, jobs, self.jobs)
+
+        gzipJobs = [x for x in jobs if x.kind == 'gzip' and x.tmppath]
+        if gzipJobs:
+            self._findProg('gzip')
+            _gzipFiles(self.gzip, [x.tmppath for x in gzipJobs], self.jobs)
+            for job in gzipJobs:
+                job.tmppath += '.gz'
+
+        for job in jobs:
+            if not job.tmppath:
+                self._recompressExternal(job)
+            os.chmod(job.tmppath, os.lstat(job.fullpath).st_mode)
+            os.rename(job.tmppath, job.fullpath)
+            if job.path in self.recipe.magic:
+                del self.recipe.magic[job.path]
+            if job.cacheKey is not None:
+                _policyutil.storeCachedFile(self, job.cacheKey, job.path)
+
+    def _findProg(self, prog):
+        if prog == 'gzip':
             if not self.gzip:
-                self.gzip = _findProg('gzip')
+                self.gzip = _policyutil.findProgPath(prog, self.recipe)
+        elif not self.bzip:
+            self.bzip = _policyutil.findProgPath(prog, self.recipe)
+
+    def _mktmp(self, fullpath):
+        fd, path = tempfile.mkstemp('.temp', '', os.path.dirname(fullpath))
+        os.close(fd)
+        return path
+
+    def _recompress(self, job):
+        # may run in a worker thread: leaves the job's tmppath unset
+        # for anything to be done with the external tools instead
+        if job.kind == 'bzip' and bz2 is None:
+            return
+        tmppath = self._mktmp(job.fullpath)
+        f = open(tmppath, 'wb')
+        try:
+            try:
+                if job.kind == 'gzip':
+                    _decompressFile(job.fullpath, f.write, 'gzip')
+                else:
+                    compressor = bz2.BZ2Compressor(9)
+                    def write(data):
+                        f.write(compressor.compress(data))
+                    _decompressFile(job.fullpath, write, 'bzip')
+                    f.write(compressor.flush())
+            finally:
+                f.close()
+        except _DecompressError:
+            os.unlink(tmppath)
+            return
+        job.tmppath = tmppath
+
+    def _recompressExternal(self, job):
+        job.tmppath = self._mktmp(job.fullpath)
+        if job.kind == 'gzip':
+            self._findProg('gzip')
             util.execute('%s -dc %s | %s -f -n -9 > %s'
-                         %(self.gzip, fullpath, self.gzip, tmppath))
-            _move(tmppath, fullpath)
-            del self.recipe.magic[path]
-        if m.name == 'bzip' and m.contents['compression'] != '9':
-            tmppath = _mktmp(fullpath)
-            if not self.bzip:
-                self.bzip = _findProg('bzip2')
+                         %(self.gzip, job.fullpath, self.gzip, job.tmppath))
+        else:
+            self._findProg('bzip2')
             util.execute('%s -dc %s | %s -9 > %s'
-                         %(self.bzip, fullpath, self.bzip, tmppath))
-            _move(tmppath, fullpath)
-            del self.recipe.magic[path]
+                         %(self.bzip, job.fullpath, self.bzip, job.tmppath))
 
 
 class NormalizeManPages(policy.DestdirPolicy):
@@ -185,160 +519,256 @@ class NormalizeManPages(policy.DestdirPolicy):
     )
 
     def _findProg(self, prog):
-        if not self.db:
-            self.db = database.Database(self.recipe.cfg.root,
-                                        self.recipe.cfg.dbPath)
-        return _findProgPath(prog, self.db, self.recipe)
+        return _policyutil.findProgPath(prog, self.recipe)
 
     # Note: not safe for derived packages; needs to check in each
     # internal function for unmodified files
-    def _uncompress(self, dirname, names):
-        for name in names:
-            path = dirname + os.sep + name
-            if name.endswith('.gz') and util.isregular(path):
-                if not self.gunzip:
-                    self.gunzip = self._findProg('gunzip')
-                util.execute('gunzip ' + dirname + os.sep + name)
-                try:
-                    self.recipe.recordMove(util.joinPaths(dirname, name),
-                            util.joinPaths(dirname, name)[:-3])
-                except AttributeError:
-                    pass
-            if name.endswith('.bz2') and util.isregular(path):
-                if not self.bunzip:
-                    self.bunzip = self._findProg('bunzip2')
-                util.execute('bunzip2 ' + dirname + os.sep + name)
-                try:
-                    self.recipe.recordMove(util.joinPaths(dirname, name),
-                            util.joinPaths(dirname, name)[:-4])
-                except AttributeError:
-                    pass
-
-    def _touchup(self, dirname, names):
+    def _scan(self, manpath):
+        # one walk of the tree: returns its directories, and the
+        # (dirname, name) of its regular files and of its symlinks
+        dirs = []
+        pages = []
+        links = []
+        for dirname, subdirs, names in os.walk(manpath):
+            dirs.append(dirname)
+            for name in sorted(subdirs + names):
+                mode = os.lstat(dirname + os.sep + name)[stat.ST_MODE]
+                if stat.S_ISLNK(mode):
+                    links.append((dirname, name))
+                elif stat.S_ISREG(mode):
+                    pages.append((dirname, name))
+        return dirs, pages, links
+
+    def _uncompress(self, item):
+        # may run in a worker thread: returns the uncompressed name,
+        # or None to leave the page to gunzip or bunzip2
+        dirname, name = item
+        newPath = _uncompressFile(dirname + os.sep + name)
+        if newPath is None:
+            return None
+        return os.path.basename(newPath)
+
+    def _uncompressExternal(self, dirname, name):
+        if name.endswith('.gz'):
+            if not self.gunzip:
+                self.gunzip = self._findProg('gunzip')
+            util.execute('gunzip ' + dirname + os.sep + name)
+            return name[:-3]
+        if not self.bunzip:
+            self.bunzip = self._findProg('bunzip2')
+        util.execute('bunzip2 ' + dirname + os.sep + name)
+        return name[:-4]
+
+    def _touchup(self, dirname, name):
         """
         remove destdir, fix up modes, ensure that it is legal UTF-8
         """
-        mode = os.lstat(dirname)[stat.ST_MODE]
-        if mode & 0777 != 0755:
-            os.chmod(dirname, 0755)
-        for name in names:
-            path = dirname + os.sep + name
-            mode = os.lstat(path)[stat.ST_MODE]
-            # avoid things like symlinks
-            if not stat.S_ISREG(mode):
-                continue
-            if mode & 0777 != 0644:
-                os.chmod(path, 0644)
-            f = file(path, 'r+')
-            data = f.read()
-            write = False
+        path = dirname + os.sep + name
+        mode = os.lstat(path)[stat.ST_MODE]
+        if mode & 0777 != 0644:
+            os.chmod(path, 0644)
+        self._touchupFile(path[len(self.macros.destdir):])
+
+    def _scanPage(self, path):
+        # returns whether the page is valid UTF-8 and whether it
+        # mentions the destdir, reading a block at a time
+        isUTF8 = True
+        hasDestdir = False
+        undecoded = ''
+        tail = ''
+        f = file(path)
+        try:
+            while isUTF8 or not hasDestdir:
+                data = f.read(_blockSize)
+                if not data:
+                    break
+                if isUTF8:
+                    data = undecoded + data
+                    try:
+                        consumed = codecs.utf_8_decode(data, 'strict',
+                                                       False)[1]
+                        undecoded = data[consumed:]
+                    except UnicodeDecodeError:
+                        isUTF8 = False
+                if not hasDestdir:
+                    data = tail + data
+                    hasDestdir = data.find(self.destdir) != -1
+                    tail = data[max(0, len(data)-len(self.destdir)+1):]
+        finally:
+            f.close()
+        if undecoded:
+            # ends partway through a character
+            isUTF8 = False
+        return isUTF8, hasDestdir
+
+    @_policyutil.cachedFile
+    def _touchupFile(self, path):
+        path = self.macros.destdir + path
+        isUTF8, hasDestdir = self._scanPage(path)
+        if isUTF8 and not hasDestdir:
+            return
+
+        # every byte string decodes as iso-8859-1
+        replacers = []
+        if hasDestdir:
+            replacers = [_StreamReplacer('/'+self.destdir),
+                         _StreamReplacer(self.destdir)]
+        fd, tmppath = tempfile.mkstemp('.temp', '', os.path.dirname(path))
+        out = os.fdopen(fd, 'w')
+        try:
             try:
-                data.decode('utf-8')
-            except:
-                try:
-                    data = data.decode('iso-8859-1').encode('utf-8')
-                    write = True
-                except:
-                    self.error('unable to decode %s as utf-8 or iso-8859-1',
-                               path)
-            if data.find(self.destdir) != -1:
-                write = True
-                # I think this is cheaper than using a regexp
-                data = data.replace('/'+self.destdir, '')
-                data = data.replace(self.destdir, '')
-
-            if write:
-                f.seek(0)
-                f.truncate(0)
-                f.write(data)
-
-
-    def _sosymlink(self, dirname, names):
-        section = os.path.basename(dirname)
-        for name in names:
-            path = dirname + os.sep + name
-            if util.isregular(path):
-                # if only .so, change to symlink
                 f = file(path)
-                lines = f.readlines(512) # we really don't need the whole file
-                f.close()
-
-                # delete comment lines first
-                newlines = []
-                for line in lines:
-                    # newline means len(line) will be at least 1
-                    if len(line) > 1 and not self.commentexp.search(line[:-1]):
-                        newlines.append(line)
-                lines = newlines
-
-                # now see if we have only a .so line to replace
-                # only replace .so with symlink if the file exists
-                # in order to deal with searchpaths
-                if len(lines) == 1:
-                    line = lines[0]
-                    # remove newline and other trailing whitespace if it exists
-                    line = line.rstrip()
-                    match = self.soexp.search(line)
-                    if match:
-                        matchlist = match.group(1).split('/')
-                        l = len(matchlist)
-                        if l == 1 or matchlist[l-2] == section:
-                            # no directory specified, or in the same
-                            # directory:
-                            targetpath = os.sep.join((dirname, matchlist[l-1]))
-                            if (os.path.exists(targetpath) and
-                                os.path.isfile(targetpath)):
-                                self.info('replacing %s (%s) with symlink %s',
-                                          name, match.group(0),
-                                          os.path.basename(match.group(1)))
-                                os.remove(path)
-                                os.symlink(os.path.basename(match.group(1)),
-                                           path)
-                        else:
-                            # either the canonical .so manN/foo.N or an
-                            # absolute path /usr/share/man/manN/foo.N
-                            # .so is relative to %(mandir)s and the other
-                            # man page is in a different dir, so add ../
-                            target = "../%s/%s" %(matchlist[l-2],
-                                                  matchlist[l-1])
-                            targetpath = os.sep.join((dirname, target))
-                            if os.path.exists(targetpath):
-                                self.info('replacing %s (%s) with symlink %s',
-                                          name, match.group(0), target)
-                                os.remove(path)
-                                os.symlink(target, path)
-
-    def _compress(self, dirname, names):
-        for name in names:
-            path = dirname + os.sep + name
-            if util.isregular(path):
-                if not self.gzip:
-                    self.gzip = self._findProg('gzip')
-                util.execute('gzip -f -n -9 ' + dirname + os.sep + name)
                 try:
-                    self.recipe.recordMove(dirname + os.sep + name,
-                            dirname + os.sep + name + '.gz')
-                except AttributeError:
-                    pass
+                    while True:
+                        data = f.read(_blockSize)
+                        if not data:
+                            break
+                        if not isUTF8:
+                            data = data.decode('iso-8859-1').encode('utf-8')
+                        for replacer in replacers:
+                            data = replacer.feed(data)
+                        out.write(data)
+                    data = ''
+                    for replacer in replacers:
+                        data = replacer.feed(data) + replacer.flush()
+                    out.write(data)
+                finally:
+                    f.close()
+            finally:
+                out.close()
+        except:
+            os.unlink(tmppath)
+            raise
+        os.chmod(tmppath, stat.S_IMODE(os.lstat(path).st_mode))
+        os.rename(tmppath, path)
+
+    def _sosymlink(self, dirname, name):
+        # returns True if the page was replaced with a symlink
+        section = os.path.basename(dirname)
+        path = dirname + os.sep + name
+        # if only .so, change to symlink
+        f = file(path)
+        lines = f.readlines(512) # we really don't need the whole file
+        f.close()
 
-    def _gzsymlink(self, dirname, names):
-        for name in names:
-            path = dirname + os.sep + name
-            if os.path.islink(path):
-                # change symlinks to .gz -> .gz
-                contents = os.readlink(path)
+        # delete comment lines first
+        newlines = []
+        for line in lines:
+            # newline means len(line) will be at least 1
+            if len(line) > 1 and not self.commentexp.search(line[:-1]):
+                newlines.append(line)
+        lines = newlines
+
+        # now see if we have only a .so line to replace
+        # only replace .so with symlink if the file exists
+        # in order to deal with searchpaths
+        if len(lines) != 1:
+            return False
+        line = lines[0]
+        # remove newline and other trailing whitespace if it exists
+        line = line.rstrip()
+        match = self.soexp.search(line)
+        if not match:
+            return False
+        matchlist = match.group(1).split('/')
+        l = len(matchlist)
+        if l == 1 or matchlist[l-2] == section:
+            # no directory specified, or in the same
+            # directory:
+            targetpath = os.sep.join((dirname, matchlist[l-1]))
+            if (os.path.exists(targetpath) and
+                os.path.isfile(targetpath)):
+                self.info('replacing %s (%s) with symlink %s',
+                          name, match.group(0),
+                          os.path.basename(match.group(1)))
+                os.remove(path)
+                os.symlink(os.path.basename(match.group(1)),
+                           path)
+                return True
+        else:
+            # either the canonical .so manN/foo.N or an
+            # absolute path /usr/share/man/manN/foo.N
+            # .so is relative to %(mandir)s and the other
+            # man page is in a different dir, so add ../
+            target = "../%s/%s" %(matchlist[l-2],
+                                  matchlist[l-1])
+            targetpath = os.sep.join((dirname, target))
+            if os.path.exists(targetpath):
+                self.info('replacing %s (%s) with symlink %s',
+                          name, match.group(0), target)
                 os.remove(path)
-                if not contents.endswith('.gz'):
-                    contents = contents + '.gz'
-                if not path.endswith('.gz'):
-                    path = path + '.gz'
-                os.symlink(util.normpath(contents), path)
+                os.symlink(target, path)
+                return True
+        return False
+
+    def _gzsymlink(self, dirname, name):
+        path = dirname + os.sep + name
+        # change symlinks to .gz -> .gz
+        contents = os.readlink(path)
+        os.remove(path)
+        if not contents.endswith('.gz'):
+            contents = contents + '.gz'
+        if not path.endswith('.gz'):
+            path = path + '.gz'
+        os.symlink(util.normpath(contents), path)
+
+    def _recordMove(self, src, dest):
+        try:
+            self.recipe.recordMove(src, dest)
+        except AttributeError:
+            pass
+
+    def _normalize(self, manpath):
+        dirs, pages, links = self._scan(manpath)
+        for dirname in dirs:
+            mode = os.lstat(dirname)[stat.ST_MODE]
+            if mode & 0777 != 0755:
+                os.chmod(dirname, 0755)
+
+        # uncompress all man pages, in process where possible
+        compressed = [x for x in pages
+                      if x[1].endswith('.gz') or x[1].endswith('.bz2')]
+        newNames = dict(zip(compressed, _policyutil.parallelMap(
+            self._uncompress, compressed, self.jobs)))
+        uncompressed = []
+        for dirname, name in pages:
+            if (dirname, name) in newNames:
+                newName = newNames[(dirname, name)]
+                if newName is None:
+                    newName = self._uncompressExternal(dirname, name)
+                self._recordMove(util.joinPaths(dirname, name),
+                                 util.joinPaths(dirname, newName))
+                name = newName
+            uncompressed.append((dirname, name))
+
+        # remove '/?%(destdir)s' and fix modes, then make .so foo.n
+        # a symlink to foo.n
+        regular = []
+        for dirname, name in uncompressed:
+            self._touchup(dirname, name)
+            if self._sosymlink(dirname, name):
+                links.append((dirname, name))
+            else:
+                regular.append((dirname, name))
+
+        # recompress all man pages
+        if regular:
+            if not self.gzip:
+                self.gzip = self._findProg('gzip')
+            _gzipFiles('gzip', [x[0] + os.sep + x[1] for x in regular],
+                       self.jobs)
+            for dirname, name in regular:
+                self._recordMove(dirname + os.sep + name,
+                                 dirname + os.sep + name + '.gz')
+
+        # change all symlinks to point to .gz (if they don't already)
+        for dirname, name in links:
+            self._gzsymlink(dirname, name)
 
     def __init__(self, *args, **keywords):
         policy.DestdirPolicy.__init__(self, *args, **keywords)
         self.soexp = re.compile(r'^\.so (.*\...*)$')
         self.commentexp = re.compile(r'^\.\\"')
-        self.db = None
         self.gzip = None
         self.gunzip = None
         self.bunzip = None
@@ -350,6 +780,7 @@ class NormalizeManPages(policy.DestdirPolicy):
         return True
 
     def do(self):
+        self.jobs = _policyutil.getJobCount(self.recipe)
         for manpath in sorted(list(set((
                 self.macros.mandir,
                 os.sep.join((self.macros.x11prefix, 'man')),
@@ -357,16 +788,7 @@ class NormalizeManPages(policy.DestdirPolicy):
             ):
             manpath = self.macros.destdir + manpath
             self.destdir = self.macros['destdir'][1:] # without leading /
-            # uncompress all man pages
-            os.path.walk(manpath, NormalizeManPages._uncompress, self)
-            # remove '/?%(destdir)s' and fix modes
-            os.path.walk(manpath, NormalizeManPages._touchup, self)
-            # .so foo.n becomes a symlink to foo.n
-            os.path.walk(manpath, NormalizeManPages._sosymlink, self)
-            # recompress all man pages
-            os.path.walk(manpath, NormalizeManPages._compress, self)
-            # change all symlinks to point to .gz (if they don't already)
-            os.path.walk(manpath, NormalizeManPages._gzsymlink, self)
+            self._normalize(manpath)
 
 
 class NormalizeInfoPages(policy.DestdirPolicy):
@@ -415,22 +837,18 @@ class NormalizeInfoPages(policy.DestdirPolicy):
             infofiles = os.listdir(infofilespath)
             for file in infofiles:
                 self._moveToInfoRoot(file)
-            infofiles = os.listdir(infofilespath)
-            for file in infofiles:
-                self._processInfoFile(file)
+            self.jobs = _policyutil.getJobCount(self.recipe)
+            infofiles = sorted(os.listdir(infofilespath))
+            self._processInfoFiles(infofiles)
 
     def __init__(self, *args, **keywords):
         policy.DestdirPolicy.__init__(self, *args, **keywords)
-        self.db = None
         self.gzip = None
         self.gunzip = None
         self.bunzip = None
 
     def _findProg(self, prog):
-        if not self.db:
-            self.db = database.Database(self.recipe.cfg.root,
-                                        self.recipe.cfg.dbPath)
-        return _findProgPath(prog, self.db, self.recipe)
+        return _policyutil.findProgPath(prog, self.recipe)
 
     def _moveToInfoRoot(self, file):
         infofilespath = '%(destdir)s/%(infodir)s' %self.macros
@@ -448,46 +866,79 @@ class NormalizeInfoPages(policy.DestdirPolicy):
             except AttributeError:
                 pass
 
-    def _processInfoFile(self, file):
+    def _classify(self, file):
+        # may run in a worker thread: returns the kind of compression
+        # to undo before compressing with gzip, '' if the file only
+        # needs compressing, or None to leave it alone
         syspath = '%(destdir)s/%(infodir)s/' %self.macros + file
-        path = '%(infodir)s/' %self.macros + file
-        if not self.policyException(path):
-            m = self.recipe.magic[path]
-            if not m or m.name not in ('gzip', 'bzip'):
-                # not compressed
-                if not self.gzip:
-                    self.gzip = self._findProg('gzip')
-                util.execute('gzip -f -n -9 %s' %syspath)
-                try:
-                    self.recipe.recordMove(syspath, syspath + '.gz')
-                except AttributeError:
-                    pass
-                del self.recipe.magic[path]
-            elif m.name == 'gzip' and \
-                (m.contents['compression'] != '9' or \
-                'name' in m.contents):
-                if not self.gzip:
-                    self.gzip = self._findProg('gzip')
-                if not self.gunzip:
-                    self.gunzip = self._findProg('gunzip')
-                util.execute('gunzip %s; gzip -f -n -9 %s'
-                            %(syspath, syspath[:-3]))
-                # filename didn't change, so don't record it in the manifest
-                del self.recipe.magic[path]
-            elif m.name == 'bzip':
-                # should use gzip instead
-                if not self.gzip:
-                    self.gzip = self._findProg('gzip')
-                if not self.bunzip:
-                    self.bunzip = self._findProg('bunzip2')
-                util.execute('bunzip2 %s; gzip -f -n -9 %s'
-                            %(syspath, syspath[:-4]))
-                try:
-                    self.recipe.recordMove(syspath, syspath[:-4] + '.gz')
-                except AttributeError:
-                    pass
+        if not util.isregular(syspath):
+            # not compressed
+            return ''
+        kind, normalized = _compressionType(syspath)
+        if kind is None:
+            return ''
+        if kind == 'gzip' and normalized:
+            return None
+        # bzip2 files should use gzip instead
+        return kind
+
+    def _uncompress(self, file):
+        # may run in a worker thread
+        syspath = '%(destdir)s/%(infodir)s/' %self.macros + file
+        return _uncompressFile(syspath)
+
+    def _processInfoFiles(self, files):
+        files = [x for x in files
+                 if not self.policyException('%(infodir)s/' %self.macros + x)]
+        kinds = _policyutil.parallelMap(self._classify, files, self.jobs)
+        work = [(x, y) for x, y in zip(files, kinds) if y is not None]
+        if not work:
+            return
+        if not self.gzip:
+            self.gzip = self._findProg('gzip')
+
+        compressed = [x for x, kind in work if kind]
+        uncompressed = dict(zip(compressed, _policyutil.parallelMap(
+            self._uncompress, compressed, self.jobs)))
+        toCompress = []
+        for file, kind in work:
+            syspath = '%(destdir)s/%(infodir)s/' %self.macros + file
+            if kind == 'gzip':
+                newPath = syspath[:-3]
+            elif kind == 'bzip':
+                newPath = syspath[:-4]
+            else:
+                newPath = syspath
+            if kind and uncompressed[file] is None:
+                if kind == 'gzip':
+                    if not self.gunzip:
+                        self.gunzip = self._findProg('gunzip')
+                    util.execute('gunzip %s' %syspath)
+                else:
+                    if not self.bunzip:
+                        self.bunzip = self._findProg('bunzip2')
+                    util.execute('bunzip2 %s' %syspath)
+            toCompress.append(newPath)
+        _gzipFiles('gzip', toCompress, self.jobs)
+
+        for file, kind in work:
+            syspath = '%(destdir)s/%(infodir)s/' %self.macros + file
+            path = '%(infodir)s/' %self.macros + file
+            if kind == '':
+                self._recordMove(syspath, syspath + '.gz')
+            elif kind == 'bzip':
+                self._recordMove(syspath, syspath[:-4] + '.gz')
+            # a recompressed gzip file keeps its name, so it is not
+            # recorded in the manifest
+            if path in self.recipe.magic:
                 del self.recipe.magic[path]
 
+    def _recordMove(self, src, dest):
+        try:
+            self.recipe.recordMove(src, dest)
+        except AttributeError:
+            pass
+
 
 class NormalizeInitscriptLocation(policy.DestdirPolicy):
     """
@@ -581,11 +1032,8 @@ class NormalizeInitscriptContents(policy.DestdirPolicy):
     invariantsubtrees = [ '%(initdir)s' ]
     invariantinclusions = [ ('.*', 0400, stat.S_IFDIR), ]
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
-
         m = self.recipe.macros
         fullpath = '/'.join((m.destdir, path))
         if os.path.islink(fullpath):
@@ -603,23 +1051,40 @@ class NormalizeInitscriptContents(policy.DestdirPolicy):
                             (path, linkpath))
                     return
 
-        contents = file(fullpath).read()
-        modified = False
-        if ('/etc/rc.d/init.d' != m.initdir and
-            '/etc/rc.d/init.d' in contents):
-            contents = contents.replace('/etc/rc.d/init.d', m.initdir)
-            modified = True
-        elif ('/etc/init.d' != m.initdir and
-              '/etc/init.d' in contents):
-            contents = contents.replace('/etc/init.d', m.initdir)
-            modified = True
-
-        if '%(initdir)s/functions' %m in contents:
+        # one pass finds which directory to replace, and whether the
+        # script uses the functions file once it is replaced
+        oldDirs = [x for x in ('/etc/rc.d/init.d', '/etc/init.d')
+                   if x != m.initdir]
+        functions = '%(initdir)s/functions' %m
+        found = dict.fromkeys(oldDirs, False)
+        usesFunctions = dict.fromkeys([None] + oldDirs, False)
+        f = file(fullpath)
+        try:
+            for line in f:
+                if functions in line:
+                    usesFunctions[None] = True
+                for oldDir in oldDirs:
+                    newLine = line
+                    if oldDir in line:
+                        found[oldDir] = True
+                        newLine = line.replace(oldDir, m.initdir)
+                    if functions in newLine:
+                        usesFunctions[oldDir] = True
+        finally:
+            f.close()
+        oldDir = None
+        for x in oldDirs:
+            if found[x]:
+                oldDir = x
+                break
+
+        if usesFunctions[oldDir]:
             self.recipe.Requires('file: %(initdir)s/functions',
                                  util.literalRegex(path))
 
-        if modified:
-            file(fullpath, 'w').write(contents)
+        if oldDir is not None:
+            _rewriteLines(fullpath,
+                          lambda line: line.replace(oldDir, m.initdir))
 
 
 class NormalizeAppDefaults(policy.DestdirPolicy):
@@ -704,11 +1169,8 @@ class NormalizeInterpreterPaths(policy.DestdirPolicy):
     processUnmodified = False
     invariantexceptions = [ '%(thisdocdir.literalRegex)s/', ]
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
-
         destdir = self.recipe.macros.destdir
         d = util.joinPaths(destdir, path)
         
@@ -802,18 +1264,7 @@ class NormalizeInterpreterPaths(policy.DestdirPolicy):
         return False
 
     def _changeInterpLine(self, path, newline):
-        mode = os.lstat(path)[stat.ST_MODE]
-        # we need to be able to write the file
-        os.chmod(path, mode | 0600)
-        f = file(path, 'r+')
-        l = f.readlines()
-        l[0] = newline
-        f.seek(0)
-        f.truncate(0)# we may have shrunk the file, avoid garbage
-        f.writelines(l)
-        f.close()
-        # revert any change to mode
-        os.chmod(path, mode)
+        _replaceFirstLine(path, lambda line: newline)
        
 
 class NormalizePamConfig(policy.DestdirPolicy):
@@ -842,34 +1293,75 @@ class NormalizePamConfig(policy.DestdirPolicy):
         '%(sysconfdir)s/pam.d/',
     ]
 
-    def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
+    stackRe = re.compile('(.*)required.*pam_stack.so.*service=(.*)')
+
+    def _fixLine(self, line):
+        line = line.replace('/lib/security/$ISA/', '')
+        m = self.stackRe.match(line)
+        if m:
+            return '%s include %s\n'%(m.group(1), m.group(2))
+        return line
 
+    @_policyutil.skipCapsuleFiles
+    def doFile(self, path):
         d = util.joinPaths(self.recipe.macros.destdir, path)
         mode = os.lstat(d)[stat.ST_MODE]
         if stat.S_ISLNK(mode):
             # we'll process whatever this is pointing to whenever we
             # get there.
             return
-        if not (mode & 0200):
-            os.chmod(d, mode | 0200)
-        f = file(d, 'r+')
-        l = f.readlines()
-        l = [x.replace('/lib/security/$ISA/', '') for x in l]
-        stackRe = re.compile('(.*)required.*pam_stack.so.*service=(.*)')
-        def removeStack(line):
-            m = stackRe.match(line)
-            if m:
-                return '%s include %s\n'%(m.group(1), m.group(2))
-            return line
-        l = [removeStack(x) for x in l]
-        f.seek(0)
-        f.truncate(0) # we may have shrunk the file, avoid garbage
-        f.writelines(l)
-        f.close()
-        os.chmod(d, mode)
+        _rewriteLines(d, self._fixLine)
+
+class _DirectoryIndex(object):
+    """
+    The entries of one directory indexed by the file they resolve to
+    and by size, for finding the other names of a file and the files
+    with the same contents.  Contents are hashed only for files whose
+    size matches the file being looked up.
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.byInode = {}
+        self.bySize = {}
+        self.digests = {}
+        for name in os.listdir(dirname):
+            try:
+                st = os.stat('/'.join((dirname, name)))
+            except OSError:
+                # dangling symlink
+                continue
+            self.byInode.setdefault((st.st_dev, st.st_ino), []).append(name)
+            if stat.S_ISREG(st.st_mode):
+                self.bySize.setdefault(st.st_size, []).append(name)
+
+    def _digest(self, name):
+        digest = self.digests.get(name)
+        if digest is None:
+            digest = _policyutil.hashFile('/'.join((self.dirname, name)))
+            self.digests[name] = digest
+        return digest
+
+    def getSameFile(self, name):
+        st = os.stat('/'.join((self.dirname, name)))
+        return list(self.byInode.get((st.st_dev, st.st_ino), []))
+
+    def getSameContents(self, name):
+        st = os.stat('/'.join((self.dirname, name)))
+        names = []
+        candidates = self.bySize.get(st.st_size, [])
+        if candidates:
+            digest = self._digest(name)
+            for candidate in candidates:
+                try:
+                    if self._digest(candidate) == digest:
+                        names.append(candidate)
+                except IOError:
+                    # this is a fallback for a bad install anyway, so
+                    # a failure here is both unusual and not important
+                    pass
+        return names
+
 
 class NormalizePythonInterpreterVersion(policy.DestdirPolicy):
     """
@@ -927,19 +1419,19 @@ class NormalizePythonInterpreterVersion(policy.DestdirPolicy):
     def preProcess(self):
         self.interpreterRe = re.compile(".*python[-0-9.]+$")
         self.interpMap = {}
+        # interpreters are looked up in directories of the destdir
+        # that this policy only changes scripts in, so each
+        # directory is indexed once
+        self.dirIndexes = {}
         versionMap = {}
         for item in self.versionMap.items():
             versionMap[item[0]%self.macros] = item[1]%self.macros
         self.versionMap = versionMap
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
-
         destdir = self.recipe.macros.destdir
         d = util.joinPaths(destdir, path)
-        mode = os.lstat(d)[stat.ST_MODE]
         m = self.recipe.magic[path]
         if m and m.name == 'script':
             interp = m.contents['interpreter']
@@ -963,18 +1455,8 @@ class NormalizePythonInterpreterVersion(policy.DestdirPolicy):
             else:
                 return
 
-            # we need to be able to write the file
-            os.chmod(d, mode | 0600)
-            f = file(d, 'r+')
-            l = f.readlines()
-            l[0] = l[0].replace(interp, normalized)
-            # we may have shrunk the file, avoid garbage
-            f.seek(0)
-            f.truncate(0)
-            f.writelines(l)
-            f.close()
-            # revert any change to mode
-            os.chmod(d, mode)
+            _replaceFirstLine(d,
+                lambda line: line.replace(interp, normalized))
 
             self.info('changed %s to %s in %s', interp, normalized, path)
             del self.recipe.magic[path]
@@ -992,28 +1474,22 @@ class NormalizePythonInterpreterVersion(policy.DestdirPolicy):
 
         links = []
         if os.path.exists(interpFull):
-            for i in os.listdir(interpFullDir):
-                if os.path.samefile(interpFull, '/'.join((interpFullDir, i))):
-                    links += [i]
+            index = self.dirIndexes.get(interpFullDir)
+            if index is None:
+                index = _DirectoryIndex(interpFullDir)
+                self.dirIndexes[interpFullDir] = index
+            links = index.getSameFile(interpFullBase)
             path = sorted(links, key=len, reverse=True)
             if path and self._isNormalizedInterpreter('/'.join((interpFullDir, path[0]))):
                 return os.path.join(interpDir, path[0])
        
-            links = []
-            for i in os.listdir(interpFullDir):
-                try:
-                    if filecmp.cmp(interpFull, '/'.join((interpFullDir, i))):
-                        links += [i]
-                except IOError:
-                    # this is a fallback for a bad install anyway, so
-                    # a failure here is both unusual and not important
-                    pass
+            links = index.getSameContents(interpFullBase)
             path = sorted(links, key=len, reverse=True)
             if path and self._isNormalizedInterpreter('/'.join((interpFullDir, path[0]))):
                 return os.path.join(interpDir, path[0])
         
         else:
-            db = database.Database('/', self.recipe.cfg.dbPath)
+            db = _policyutil.openDatabase(self.recipe, root='/')
             pythonTroveList = db.iterTrovesByPath(interp)
             for trove in pythonTroveList:
                 pathList = [x[1] for x in trove.iterFileList()]
@@ -1024,6 +1500,77 @@ class NormalizePythonInterpreterVersion(policy.DestdirPolicy):
 
         return None
 
+def _zipMemberTime(info):
+    # the UTC modification time from an extended timestamp field, as
+    # unzip prefers, otherwise the local time in the entry itself
+    extra = info.extra
+    while len(extra) >= 4:
+        fieldId, size = struct.unpack('<HH', extra[:4])
+        data = extra[4:4+size]
+        if fieldId == 0x5455 and len(data) >= 5 and ord(data[0]) & 1:
+            return struct.unpack('<l', data[1:5])[0]
+        extra = extra[4+size:]
+    return time.mktime(info.date_time + (0, 0, -1))
+
+
+def _unzipFile(path, destDir):
+    """
+    Extract the zip archive at C{path} into C{destDir} as C{unzip -q -o}
+    would, streaming each member to disk and keeping modes and times.
+    Returns C{False}, having extracted nothing, for archives that
+    should be left to unzip: ones with symlinks, encrypted or unsafe
+    members, members compressed other than stored or deflated, or
+    without Unix modes.
+    """
+    if not hasattr(zipfile.ZipFile, 'open'):
+        # no streaming before python 2.6
+        return False
+    archive = zipfile.ZipFile(path)
+    try:
+        members = archive.infolist()
+        for info in members:
+            mode = info.external_attr >> 16
+            name = info.filename
+            if (info.create_system != 3 or not mode & 0777
+                or info.compress_type not in (zipfile.ZIP_STORED,
+                                              zipfile.ZIP_DEFLATED)
+                or stat.S_ISLNK(mode) or info.flag_bits & 0x1
+                or name.startswith('/') or '..' in name.split('/')):
+                return False
+
+        dirs = []
+        for info in members:
+            mode = info.external_attr >> 16
+            target = os.path.join(destDir, info.filename)
+            if info.filename.endswith('/'):
+                util.mkdirChain(target)
+                dirs.append((target, info))
+                continue
+            util.mkdirChain(os.path.dirname(target))
+            src = archive.open(info)
+            try:
+                dest = open(target, 'wb')
+                try:
+                    shutil.copyfileobj(src, dest, _blockSize)
+                finally:
+                    dest.close()
+            finally:
+                src.close()
+            # unzip drops setuid, setgid and sticky bits
+            os.chmod(target, mode & 0777)
+            mtime = _zipMemberTime(info)
+            os.utime(target, (mtime, mtime))
+        # directories last, so that their times stick
+        dirs.sort(reverse=True)
+        for target, info in dirs:
+            os.chmod(target, (info.external_attr >> 16) & 0777)
+            mtime = _zipMemberTime(info)
+            os.utime(target, (mtime, mtime))
+    finally:
+        archive.close()
+    return True
+
+
 class NormalizePythonEggs(policy.DestdirPolicy):
     invariantinclusions = [
         ('.*/python[^/]*/site-packages/.*\.egg', stat.S_IFREG),
@@ -1033,23 +1580,53 @@ class NormalizePythonEggs(policy.DestdirPolicy):
         ('RemoveNonPackageFiles', policy.CONDITIONAL_PRIOR),
     )
 
-    def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
+    def preProcess(self):
+        # doFile collects the eggs and postProcess unpacks them
+        self.jobs = _policyutil.getJobCount(self.recipe)
+        self.eggs = []
 
+    @_policyutil.skipCapsuleFiles
+    def doFile(self, path):
         dir = self.recipe.macros.destdir
         fullPath = util.joinPaths(dir, path)
-        m = magic.magic(fullPath)
+        m = self.recipe.magic[path]
         if not (m and m.name == 'ZIP'):
             # if it's not a zip, we can't unpack it, PythonEggs will raise
             # an error on this path
             return
+        self.eggs.append((path, fullPath))
+
+    def _unpack(self, item):
+        # may run in a worker thread: returns the directory holding
+        # the unpacked egg and whether it still needs unzip
+        path, fullPath = item
         tmpPath = tempfile.mkdtemp(dir = self.recipe.macros.builddir)
-        util.execute("unzip -q -o -d '%s' '%s'" % (tmpPath, fullPath))
-        self._addActionPathBuildRequires(['unzip'])
-        os.unlink(fullPath)
-        shutil.move(tmpPath, fullPath)
+        try:
+            if _unzipFile(fullPath, tmpPath):
+                return tmpPath, False
+        except (zipfile.BadZipfile, zlib.error, IOError, OSError,
+                NotImplementedError, RuntimeError):
+            pass
+        # start again with unzip
+        shutil.rmtree(tmpPath)
+        os.mkdir(tmpPath)
+        return tmpPath, True
+
+    def postProcess(self):
+        eggs = self.eggs
+        self.eggs = []
+        results = _policyutil.parallelMap(self._unpack, eggs, self.jobs)
+        for (path, fullPath), (tmpPath, useUnzip) in zip(eggs, results):
+            if useUnzip:
+                util.execute("unzip -q -o -d '%s' '%s'" % (tmpPath, fullPath))
+                self._addActionPathBuildRequires(['unzip'])
+            os.unlink(fullPath)
+            shutil.move(tmpPath, fullPath)
+            if path in self.recipe.magic:
+                del self.recipe.magic[path]
 
 
 # Note: NormalizeLibrarySymlinks is in libraries.py
+
+
+_policyutil.profilePolicies(globals())
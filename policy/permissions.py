@@ -15,12 +15,17 @@
 #
 
 
+import imp
 import os
 import stat
+import sys
 
 from conary.lib import util
 from conary.build import policy
 
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
+
 
 class ReadableDocs(policy.DestdirPolicy):
     """
@@ -47,11 +52,8 @@ class ReadableDocs(policy.DestdirPolicy):
         '%(infodir)s/',
     ]
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
-
         d = self.macros['destdir']
         fullpath = util.joinPaths(d, path)
         mode = os.lstat(fullpath)[stat.ST_MODE]
@@ -95,18 +97,15 @@ class WarnWriteable(policy.EnforcementPolicy):
     )
     processUnmodified = False
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, filename):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(filename):
-                return
-
         fullpath = self.macros.destdir + filename
-        if os.path.islink(fullpath):
-            return
         if filename not in self.recipe.autopkg.pathMap:
             # directory has been deleted
             return
-        mode = os.lstat(fullpath)[stat.ST_MODE]
+        mode = _policyutil.lstat(self.recipe, fullpath)[stat.ST_MODE]
+        if stat.S_ISLNK(mode):
+            return
         group = self.recipe.autopkg.pathMap[filename].inode.group()
         if mode & 02 or (mode & 020 and group != 'root'):
             if stat.S_ISDIR(mode):
@@ -142,13 +141,11 @@ class WorldWriteableExecutables(policy.EnforcementPolicy):
     # calling r.SetModes should not override this policy automatically.
     invariantexceptions = [ ('.*', stat.S_IFDIR) ]
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
-
         d = self.macros['destdir']
-        mode = os.lstat(util.joinPaths(d, path))[stat.ST_MODE]
+        mode = _policyutil.lstat(self.recipe,
+                                 util.joinPaths(d, path))[stat.ST_MODE]
         if mode & 0111 and mode & 02 and not stat.S_ISLNK(mode):
             self.error(
                 "%s has executable mode 0%o with world-writeable permission",
@@ -181,16 +178,13 @@ class IgnoredSetuid(policy.EnforcementPolicy):
     """
     processUnmodified = False
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
-
-        fullpath = self.macros.destdir + path
-        mode = os.lstat(fullpath)[stat.ST_MODE]
         pathMap = self.recipe.autopkg.pathMap
         if path not in pathMap:
             return
+        fullpath = self.macros.destdir + path
+        mode = _policyutil.lstat(self.recipe, fullpath)[stat.ST_MODE]
         if mode & 06000 and not pathMap[path].inode.perms() & 06000:
             if stat.S_ISDIR(mode):
                 type = "directory"
@@ -198,3 +192,8 @@ class IgnoredSetuid(policy.EnforcementPolicy):
                 type = "file"
             self.warn('%s %s has unpackaged set{u,g}id mode 0%o in filesystem',
                       type, path, mode&06777)
+
+
+_policyutil.declareReadOnly(WarnWriteable, WorldWriteableExecutables,
+                            IgnoredSetuid)
+_policyutil.profilePolicies(globals())
@@ -16,13 +16,17 @@
 
 
 import errno
+import imp
 import itertools
 import os
+import sys
 
 from conary.build import packagepolicy
 
 from conary.deps import deps
-from conary.local import database
+
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
 
 # copied from pkgconfig.py
 if hasattr(packagepolicy, '_basePluggableRequires'):
@@ -111,12 +115,11 @@ class PHPRequires(_basePluggableRequires):
                     self.phpPathList.append(binPath)
 
     def _checkLocalSystem(self, path):
-        db = database.Database(self.cfg.root,
-                               self.cfg.dbPath)
+        lookup = _policyutil.getPathLookup(self.recipe)
         for phpPath in self.phpPathList:
             # first, do a direct check of the filesystem.
-            if db.pathIsOwned(phpPath):
-                troveList = db.iterTrovesByPath(phpPath)
+            troveList = lookup.iterTrovesByPath(phpPath)
+            if troveList:
                 return troveList[0].getName()
 
     def _checkBuildRequires(self, path):
@@ -203,3 +206,6 @@ class PHPRequires(_basePluggableRequires):
             self.warn("'%s' requires PHP, which is not provided by any " \
                     "troves. Please add a trove that provides the PHP " \
                     "interpreter to your buildRequires." % path)
+
+
+_policyutil.profilePolicies(globals())
@@ -15,14 +15,19 @@
 #
 
 
+import imp
 import itertools
 import os
 import re
+import sys
 
 from conary.build import policy, packagepolicy
 from conary.deps import deps
 from conary.lib import util
 
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
+
 
 class NormalizePkgConfig(policy.DestdirPolicy):
     """
@@ -58,11 +63,8 @@ class NormalizePkgConfig(policy.DestdirPolicy):
         '(%(prefix)s/lib|%(datadir)s)/pkgconfig/'
     ]
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, filename):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(filename):
-                return
-
         libdir = self.recipe.macros.libdir
         destdir = self.recipe.macros.destdir
         basename = os.path.basename(filename)
@@ -120,15 +122,12 @@ class PkgConfigRequires(_basePluggableRequires):
 
     invariantinclusions = [ r'(%(libdir)s|%(datadir)s)/pkgconfig/.*\.pc$' ]
 
+    # since capsules do not convert to relative symlinks,
+    # we cannot depend on getting the realpath.  Unless
+    # we resolve that, assume that capsule-provided
+    # dependencies will be sufficient for pkgconfig files.
+    @_policyutil.skipCapsuleFiles
     def addPluggableRequirements(self, path, fullpath, pkgFiles, macros):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                # since capsules do not convert to relative symlinks,
-                # we cannot depend on getting the realpath.  Unless
-                # we resolve that, assume that capsule-provided
-                # dependencies will be sufficient for pkgconfig files.
-                return
-
         # parse pkgconfig file
         variables = {}
         requirements = set()
@@ -247,3 +246,6 @@ class PkgConfigRequires(_basePluggableRequires):
                 if troveName:
                     self._addRequirement(path, troveName, [], pkgFiles,
                                          deps.TroveDependencies)
+
+
+_policyutil.profilePolicies(globals())
@@ -15,12 +15,19 @@
 #
 
 
+import imp
 import itertools
+import os
 import re
+import sys
 
 from conary.build import policy, use
 from conary.deps import deps
 
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
+
+
 class ResolveFileDependencies(policy.PackagePolicy):
     """
     NAME
@@ -71,11 +78,12 @@ class ResolveFileDependencies(policy.PackagePolicy):
     def do(self):
         self.cfg = self.recipe.cfg
         self.repos = self.recipe.getRepos()
-        self.db = self.recipe._db
 
         if use.Use.bootstrap._get():
             return
 
+        self.lookup = _policyutil.getPathLookup(self.recipe)
+
         if not hasattr(self.recipe, 'RemoveSelfProvidedRequires'):
             # Compatibility with conary 2.0.50 and earlier
             for comp in self.recipe.autopkg.getComponents():
@@ -120,10 +128,11 @@ class ResolveFileDependencies(policy.PackagePolicy):
 
         locDepSets = set()
         trvMap = {}
+        pathTroves = self.lookup.getTrovesByPaths(str(x) for x in fileDeps)
         for fDep in fileDeps.copy():
             f = str(fDep)
             trv0 = None
-            for trv in self.db.iterTrovesByPath(f):
+            for trv in pathTroves[f]:
                 if not trv0:
                     trv0 = trv
                 if trv.provides().satisfies(
@@ -197,3 +206,6 @@ class ResolveFileDependencies(policy.PackagePolicy):
             ds = self.toDepSet(d,depClass)
             s.add(ds)
         return s
+
+
+_policyutil.profilePolicies(globals())
@@ -16,49 +16,97 @@
 
 
 import errno
+import imp
 import os
 import shutil
 import stat
+import sys
 
 from conary.lib import util
 from conary.build import macros, policy
 from conary.build.use import Use
-from conary.local import database
-
-
-def _findProgPath(prog, db, recipe, error=True):
-    # ignore arguments
-    prog = prog.split(' ')[0]
-    if prog.startswith('/'):
-        progPath = prog
-    else:
-        macros = recipe.macros
-        searchPath = [macros.essentialbindir,
-                      macros.bindir,
-                      macros.essentialsbindir,
-                      macros.sbindir]
-        searchPath.extend([x for x in ['/bin', '/usr/bin', '/sbin', '/usr/sbin']
-                           if x not in searchPath])
-        searchPath.extend([x for x in os.getenv('PATH', '').split(os.path.pathsep)
-                           if x not in searchPath])
-        progPath = util.searchFile(prog, searchPath, error=error)
-
-    if not progPath and not error:
-        return None
-
-    progTroveName =  [ x.getName() for x in db.iterTrovesByPath(progPath) ]
-    if progTroveName:
-        progTroveName = progTroveName[0]
-        try:
-            if progTroveName in recipe._getTransitiveBuildRequiresNames():
-                recipe.reportExcessBuildRequires(progTroveName)
-            else:
-                recipe.reportMisingBuildRequires(progTroveName)
-        except AttributeError:
-            # older conary
-            pass
 
-    return progPath
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
+
+
+def _copyContents(src, dest):
+    # replaces the contents of dest in place, keeping its inode and mode
+    mode = os.lstat(src)[stat.ST_MODE]
+    if not mode & 0400:
+        os.chmod(src, mode|0400)
+    try:
+        shutil.copyfile(src, dest)
+    finally:
+        if not mode & 0400:
+            os.chmod(src, mode)
+
+
+class _SourceSet(object):
+    """
+    Set of source paths kept as interned basenames grouped by their
+    interned directory, so that the many files sharing a directory
+    store it only once.
+    """
+
+    def __init__(self, paths=()):
+        self.dirs = {}
+        self.update(paths)
+
+    def add(self, path):
+        dir, base = os.path.split(path)
+        dir = intern(dir)
+        names = self.dirs.get(dir)
+        if names is None:
+            names = self.dirs[dir] = set()
+        names.add(intern(base))
+
+    def update(self, paths):
+        if isinstance(paths, _SourceSet):
+            for dir, names in paths.dirs.iteritems():
+                if dir in self.dirs:
+                    self.dirs[dir].update(names)
+                else:
+                    self.dirs[dir] = set(names)
+            return
+        for path in paths:
+            self.add(path)
+
+    def __contains__(self, path):
+        dir, base = os.path.split(path)
+        return base in self.dirs.get(dir, ())
+
+    def __len__(self):
+        return sum([len(x) for x in self.dirs.itervalues()])
+
+    def __nonzero__(self):
+        return bool(self.dirs)
+
+    def __iter__(self):
+        for dir in sorted(self.dirs):
+            for base in sorted(self.dirs[dir]):
+                yield os.path.join(dir, base)
+
+
+class _StripJob(object):
+    """
+    The work C{Strip} does for one file.  C{key} identifies the work
+    for files with the same contents; C{original} is set for a file
+    that gets the results of another job instead of being stripped
+    itself, and C{hardlink} if it is a hard link to that file.
+    """
+
+    def __init__(self, path, fullpath, oldmode):
+        self.path = path
+        self.fullpath = fullpath
+        self.oldmode = oldmode
+        self.debugedit = None
+        self.command = None
+        self.debuglibpath = None
+        self.key = None
+        self.original = None
+        self.hardlink = False
+        self.debugfiles = []
 
 
 class Strip(policy.DestdirPolicy):
@@ -115,7 +163,6 @@ class Strip(policy.DestdirPolicy):
     def __init__(self, *args, **keywords):
         policy.DestdirPolicy.__init__(self, *args, **keywords)
         self.tryDebuginfo = True
-        self.db = None
 
     def updateArgs(self, *args, **keywords):
         self.debuginfo = False
@@ -149,18 +196,53 @@ class Strip(policy.DestdirPolicy):
                     ' for path replacement, add %d characters to buildPath'
                     % (len(self.macros.debugsrcdir) - len(topbuilddir)))
             self.debuginfo = True
-            self.debugfiles = set()
+            self.debugfiles = _SourceSet()
             self.dm.topbuilddir = topbuilddir
-
-    def _openDb(self):
-        if not self.db:
-            self.db = database.Database(self.recipe.cfg.root,
-                                   self.recipe.cfg.dbPath)
-
+        # with more than one job, doFile queues the work and
+        # postProcess runs it
+        self.jobs = _policyutil.getJobCount(self.recipe)
+        self.stripJobs = []
+        self.stripInodes = {}
+        self.stripKeys = {}
+        self.toolIdentities = {}
+        self.debuglibpaths = set()
+
+    def _debuglibpath(self, path):
+        dir=os.path.dirname(path)
+        b=os.path.basename(path)
+        if not b.endswith('.debug'):
+            b += '.debug'
+
+        debuglibdir = '%(destdir)s%(debuglibdir)s' %self.dm +dir
+        debuglibpath = util.joinPaths(debuglibdir, b)
+        if (os.path.exists(debuglibpath) or
+            debuglibpath in self.debuglibpaths):
+            return None
+        return debuglibpath
+
+    def _addDebuglibpath(self, job, debuglibpath):
+        util.mkdirChain(os.path.dirname(debuglibpath))
+        self.debuglibpaths.add(debuglibpath)
+        job.debuglibpath = debuglibpath
+
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
+        fullpath = self.dm.destdir+path
+        st = os.lstat(fullpath)
+        inode = (st.st_dev, st.st_ino)
+        original = self.stripInodes.get(inode)
+        if original is not None:
+            # a hard link to a file that has been stripped, or queued
+            # to be; it needs only its own debug information link
+            job = _StripJob(path, fullpath, None)
+            job.original = original
+            job.hardlink = True
+            if original.debuglibpath and not path.endswith('.o'):
+                debuglibpath = self._debuglibpath(path)
+                if debuglibpath:
+                    self._addDebuglibpath(job, debuglibpath)
+            self._addJob(job)
+            return
 
         m = self.recipe.magic[path]
         if not m:
@@ -173,70 +255,248 @@ class Strip(policy.DestdirPolicy):
         if (m.name == "ELF" and m.contents['hasDebug']) or \
            (m.name == "ar"):
             oldmode = None
-            fullpath = self.dm.destdir+path
-            mode = os.lstat(fullpath)[stat.ST_MODE]
+            mode = st[stat.ST_MODE]
             if mode & 0600 != 0600:
                 # need to be able to read and write the file to strip it
                 oldmode = mode
                 os.chmod(fullpath, mode|0600)
+            job = _StripJob(path, fullpath, oldmode)
             if self.debuginfo and m.name == 'ELF' and not path.endswith('.o'):
 
-                dir=os.path.dirname(path)
-                b=os.path.basename(path)
-                if not b.endswith('.debug'):
-                    b += '.debug'
-
-                debuglibdir = '%(destdir)s%(debuglibdir)s' %self.dm +dir
-                debuglibpath = util.joinPaths(debuglibdir, b)
-                if os.path.exists(debuglibpath):
+                debuglibpath = self._debuglibpath(path)
+                if debuglibpath is None:
                     return
 
-                self._openDb()
-                if (_findProgPath(self.macros.debugedit, self.db,
-                                  self.recipe, error=False) and
-                    _findProgPath(self.macros.strip, self.db,
-                                  self.recipe, error=False)):
-
-                    # null-separated AND terminated list, so we need to throw
-                    # away the last (empty) item before updating self.debugfiles
-                    self.debugfiles |= set(util.popen(
-                        '%(debugedit)s -b %(topbuilddir)s -d %(debugsrcdir)s'
-                        ' -l /dev/stdout '%self.dm
-                        +fullpath).read().split('\x00')[:-1])
-                    util.mkdirChain(debuglibdir)
-                    util.execute('%s -f %s %s' %(
-                        self.dm.strip, debuglibpath, fullpath))
+                if (_policyutil.findProgPath(self.macros.debugedit,
+                                             self.recipe, error=False) and
+                    _policyutil.findProgPath(self.macros.strip,
+                                             self.recipe, error=False)):
+
+                    self._addDebuglibpath(job, debuglibpath)
+                    job.debugedit = ('%(debugedit)s -b %(topbuilddir)s'
+                                     ' -d %(debugsrcdir)s -l /dev/stdout '
+                                     %self.dm +fullpath)
+                    job.command = '%s -f %s %s' %(
+                        self.dm.strip, debuglibpath, fullpath)
+                    # the stripped file names its debug file, so only
+                    # files whose debug files share a name are the same
+                    job.key = ('debuginfo', self.dm.debugedit, self.dm.strip,
+                               self.dm.topbuilddir, self.dm.debugsrcdir,
+                               os.path.basename(debuglibpath))
 
             else:
-                self._openDb()
                 if m.name == 'ar' or path.endswith('.o'):
                     # just in case strip is eu-strip, which segfaults
                     # whenever it touches an ar archive, and seems to
                     # break some .o files
-                    if _findProgPath(self.macros.strip_archive, self.db, self.recipe, error=False):
-                        util.execute('%(strip_archive)s ' %self.dm +fullpath)
+                    if _policyutil.findProgPath(self.macros.strip_archive,
+                                                self.recipe, error=False):
+                        job.command = '%(strip_archive)s ' %self.dm +fullpath
+                        job.key = ('archive', self.dm.strip_archive)
                 else:
-                    if _findProgPath(self.macros.strip, self.db, self.recipe, error=False):
-                        util.execute('%(strip)s ' %self.dm +fullpath)
-
-            del self.recipe.magic[path]
-            if oldmode is not None:
-                os.chmod(fullpath, oldmode)
+                    if _policyutil.findProgPath(self.macros.strip,
+                                                self.recipe, error=False):
+                        job.command = '%(strip)s ' %self.dm +fullpath
+                        job.key = ('strip', self.dm.strip)
+
+            self.stripInodes[inode] = job
+            if job.key is not None:
+                # byte-identical files are stripped once
+                job.key += (_policyutil.hashFile(fullpath),)
+                job.original = self.stripKeys.get(job.key)
+                if job.original is None:
+                    self.stripKeys[job.key] = job
+            self._addJob(job)
+
+    def _addJob(self, job):
+        if self.jobs > 1:
+            self.stripJobs.append(job)
+        else:
+            self._runJobs([job])
+
+    def _runJobs(self, jobs):
+        cache = _policyutil.getPolicyCache(self.recipe)
+        work = []
+        for job in jobs:
+            if job.original is not None:
+                continue
+            if cache is not None and self._restoreCached(cache, job):
+                continue
+            work.append(job)
+        results = _policyutil.parallelMap(self._strip, work, self.jobs)
+        for job, debugfiles in zip(work, results):
+            job.debugfiles = debugfiles
+            if cache is not None and job.key is not None:
+                self._storeCached(cache, job)
+        # applied in the order the files were found
+        for job in jobs:
+            self._finishStrip(job)
+
+    def _strip(self, job):
+        # may run in a worker thread: no bookkeeping here
+        debugfiles = _SourceSet()
+        if job.debugedit:
+            # null-separated AND terminated list, read as a stream
+            # since large binaries can list a great many sources
+            f = util.popen(job.debugedit)
+            try:
+                for filename in _policyutil.readRecords(f, '\x00'):
+                    if filename:
+                        debugfiles.add(filename)
+            finally:
+                f.close()
+        if job.command:
+            util.execute(job.command)
+        return debugfiles
+
+    def _finishStrip(self, job):
+        original = job.original
+        if original is not None:
+            if not job.hardlink:
+                _copyContents(original.fullpath, job.fullpath)
+            if (job.debuglibpath and original.debuglibpath
+                and os.path.exists(original.debuglibpath)):
+                try:
+                    os.link(original.debuglibpath, job.debuglibpath)
+                except OSError:
+                    shutil.copy2(original.debuglibpath, job.debuglibpath)
+        if job.debugfiles:
+            self.debugfiles.update(job.debugfiles)
+        # hard links share the stripped inode, so their magic is
+        # stale as well
+        if job.path in self.recipe.magic:
+            del self.recipe.magic[job.path]
+        if job.oldmode is not None:
+            os.chmod(job.fullpath, job.oldmode)
+
+    # macros naming the programs that each kind of job runs
+    _jobTools = {
+        'debuginfo': ('debugedit', 'strip'),
+        'archive': ('strip_archive',),
+        'strip': ('strip',),
+    }
+
+    def _toolIdentity(self, command):
+        # which build of a program runs, so that upgrading it
+        # invalidates what the cache holds from the old one
+        identity = self.toolIdentities.get(command)
+        if identity is None:
+            progPath = _policyutil.findProgPath(command, self.recipe,
+                                                error=False)
+            identity = (progPath,)
+            if progPath:
+                try:
+                    st = os.stat(progPath)
+                    identity = (progPath, st.st_size, st.st_mtime)
+                except OSError:
+                    pass
+            self.toolIdentities[command] = identity
+        return identity
+
+    def _cacheKey(self, cache, job):
+        tools = tuple(self._toolIdentity(getattr(self.dm, x))
+                      for x in self._jobTools[job.key[0]])
+        return (('Strip', cache.getSourceDigest(self.__class__))
+                + tools + job.key)
+
+    def _restoreCached(self, cache, job):
+        if job.key is None:
+            return False
+        entry = cache.get(self._cacheKey(cache, job))
+        if entry is None:
+            return False
+        strippedDigest, debugDigest, debugfiles = entry
+        if not cache.hasObject(strippedDigest):
+            return False
+        if debugDigest is not None and not cache.hasObject(debugDigest):
+            return False
+        cache.hits += 1
+        cache.restoreObject(strippedDigest, job.fullpath)
+        if debugDigest is not None and job.debuglibpath:
+            cache.restoreObject(debugDigest, job.debuglibpath)
+        job.debugfiles = _SourceSet(debugfiles)
+        return True
+
+    def _storeCached(self, cache, job):
+        cache.misses += 1
+        strippedDigest = _policyutil.hashFile(job.fullpath)
+        cache.storeObject(job.fullpath, strippedDigest)
+        debugDigest = None
+        if job.debuglibpath and os.path.exists(job.debuglibpath):
+            debugDigest = _policyutil.hashFile(job.debuglibpath)
+            cache.storeObject(job.debuglibpath, debugDigest)
+        cache.put(self._cacheKey(cache, job),
+                  (strippedDigest, debugDigest, tuple(job.debugfiles)))
 
     def postProcess(self):
+        if self.stripJobs:
+            self._runJobs(self.stripJobs)
+            self.stripJobs = []
         if self.debuginfo:
-            for filename in sorted(self.debugfiles):
-                builddirpath = '%(topbuilddir)s/' % self.dm +filename
-                dir = os.path.dirname(filename)
-                util.mkdirChain('%(destdir)s%(debugsrcdir)s/'%self.dm +dir)
-                try:
-                    targetfile = '%(destdir)s%(debugsrcdir)s/'%self.dm +filename
-                    shutil.copy2(builddirpath, targetfile)
-                    # these files only need to be readable; avoid warnings
-                    # about group-writeable files, etc.
-                    os.chmod(targetfile, 0644)
-                except IOError, msg:
-                    if msg.errno == errno.ENOENT:
-                        pass
-                    else:
-                        raise
+            self._copyDebugSources()
+
+    def _copyDebugSources(self):
+        sourcedir = '%(topbuilddir)s/' % self.dm
+        targetdir = '%(destdir)s%(debugsrcdir)s/' % self.dm
+        sources = []
+        for filename in self.debugfiles:
+            dir = os.path.dirname(filename)
+            util.mkdirChain(targetdir + dir)
+            builddirpath = sourcedir + filename
+            try:
+                st = os.stat(builddirpath)
+            except OSError, msg:
+                if msg.errno == errno.ENOENT:
+                    continue
+                raise
+            sources.append((builddirpath, targetdir + filename, st))
+
+        # Identical sources are copied once and hard linked after
+        # that: first by inode, then by contents for files whose
+        # sizes match
+        sizes = {}
+        for builddirpath, targetfile, st in sources:
+            sizes.setdefault(st.st_size, set()).add((st.st_dev, st.st_ino))
+        toHash = [x[0] for x in sources if len(sizes[x[2].st_size]) > 1]
+        digests = dict(zip(toHash, _policyutil.parallelMap(
+            _policyutil.hashFile, toHash, self.jobs)))
+        copies = {}
+        toCopy = []
+        toLink = []
+        for builddirpath, targetfile, st in sources:
+            if builddirpath in digests:
+                identity = (st.st_size, digests[builddirpath])
+            else:
+                identity = (st.st_dev, st.st_ino)
+            if identity in copies:
+                toLink.append((copies[identity], targetfile))
+            else:
+                copies[identity] = targetfile
+                toCopy.append((builddirpath, targetfile))
+
+        sizes = _policyutil.parallelMap(self._copyDebugSource, toCopy,
+                                        self.jobs)
+        for copied, targetfile in toLink:
+            if os.path.lexists(targetfile):
+                os.unlink(targetfile)
+            try:
+                os.link(copied, targetfile)
+            except OSError:
+                shutil.copy2(copied, targetfile)
+        if sources:
+            self.info('copied %d debug source files (%d bytes),'
+                      ' linked %d identical files',
+                      len(toCopy), sum(sizes), len(toLink))
+
+    def _copyDebugSource(self, item):
+        # may run in a worker thread
+        builddirpath, targetfile = item
+        size = _policyutil.copyFile(builddirpath, targetfile)
+        shutil.copystat(builddirpath, targetfile)
+        # these files only need to be readable; avoid warnings
+        # about group-writeable files, etc.
+        os.chmod(targetfile, 0644)
+        return size
+
+
+_policyutil.profilePolicies(globals())
@@ -20,8 +20,15 @@ These policies are stubs to help convert old recipes that reference
 obsolete policy.
 """
 
+import imp
+import os
+import sys
+
 from conary.build import policy
 
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
+
 class EtcConfig(policy.EnforcementPolicy):
     """
     NAME
@@ -84,3 +91,6 @@ class ObsoletePaths(policy.EnforcementPolicy):
 
     def test(self):
         return False
+
+
+_policyutil.profilePolicies(globals())
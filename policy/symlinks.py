@@ -15,13 +15,17 @@
 #
 
 
+import imp
 import os
 import re
+import sys
 
 from conary.build import filter, policy, packagepolicy
 from conary.deps import deps
 from conary.lib import util
-from conary.local import database
+
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
 
 # copied from pkgconfig.py
 if hasattr(packagepolicy, '_basePluggableRequires'): 
@@ -62,11 +66,8 @@ class FixBuilddirSymlink(policy.DestdirPolicy):
     )
     processUnmodified = False
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
-
         d = self.macros.destdir
         f = util.joinPaths(d, path)
         if not os.path.islink(f):
@@ -113,21 +114,11 @@ class SymlinkTargetRequires(_basePluggableRequires):
     ]
     processUnmodified = False
 
-    def __init__(self, *args, **keywords):
-        _basePluggableRequires.__init__(self, *args, **keywords)
-        self.db = None
-
-    def _openDb(self):
-        if not self.db:
-            self.db = database.Database(self.recipe.cfg.root,
-                                   self.recipe.cfg.dbPath)
-
     def addPluggableRequirements(self, path, fullpath, pkgFiles, macros):
         d = macros.destdir
         f = util.joinPaths(d, path)
         if not os.path.islink(f):
             return
-        self._openDb()
 
         fullpath = util.joinPaths(d, path)
         contents = os.readlink(fullpath)
@@ -142,7 +133,8 @@ class SymlinkTargetRequires(_basePluggableRequires):
             # the file is provided by the destdir, don't search for it
             return
 
-        troves = self.db.iterTrovesByPath(contents)
+        troves = _policyutil.getPathLookup(
+            self.recipe).iterTrovesByPath(contents)
         if not troves:
             # If there's a file, conary doesn't own it. either way,
             # DanglingSymlinks will fire an error.
@@ -196,11 +188,8 @@ class RelativeSymlinks(policy.DestdirPolicy):
     """
     processUnmodified = False
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
-
         fullpath = self.macros['destdir']+path
         if os.path.islink(fullpath):
             contents = os.readlink(fullpath)
@@ -269,11 +258,8 @@ class DanglingSymlinks(policy.PackagePolicy):
             self.targetFilters.append((filter.Filter(*filterargs), requirement))
         policy.PackagePolicy.doProcess(self, recipe)
 
+    @_policyutil.skipCapsuleFiles
     def doFile(self, path):
-        if hasattr(self.recipe, '_getCapsulePathsForFile'):
-            if self.recipe._getCapsulePathsForFile(path):
-                return
-
         d = self.macros.destdir
         f = util.joinPaths(d, path)
         if not os.path.islink(f):
@@ -343,3 +329,6 @@ class DanglingSymlinks(policy.PackagePolicy):
             # so the rest of policy won't barf trying to access a file which
             # doesn't *really* exist (CNP-59)
             os.unlink(self.recipe.macros.destdir+path)
+
+
+_policyutil.profilePolicies(globals())
@@ -15,9 +15,16 @@
 #
 
 
+import imp
+import os
+import sys
+
 from conary.build import policy, packagepolicy
 from conary.deps import deps
 
+_policyutil = sys.modules.get('_policyutil') or imp.load_source(
+    '_policyutil', os.path.join(os.path.dirname(__file__), '_policyutil.py'))
+
 if hasattr(packagepolicy, '_basePluggableRequires'):
     _basePluggableRequires = packagepolicy._basePluggableRequires
 else:
@@ -93,3 +100,6 @@ class XinetdConfigRequires(_basePluggableRequires):
         # dependency if the file dependency is not satisfied
         self._addRequirement(path, "/usr/sbin/xinetd", [], pkgFiles,
                              deps.FileDependencies)
+
+
+_policyutil.profilePolicies(globals())
@@ -0,0 +1,611 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Offline benchmark for conary-policy.
+
+Builds synthetic destdir, builddir and system root trees, then runs
+policies from the policy directory over them through a stub recipe,
+autopkg and local database, and reports throughput in files and
+megabytes per second.  Needs conary to be importable, but no
+repository, network access or cook.
+
+    scripts/policybench.py [--scale N] [--repeat N] [policy ...]
+
+Every policy is given a freshly generated tree for every run, since
+most of them modify it.  Only the time spent in the policy is counted.
+"""
+
+
+import bz2
+import gzip
+import imp
+import optparse
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+from conary.build import macros as conarymacros
+from conary.deps import deps
+from conary.lib import magic
+
+
+NAME = 'policybench'
+VERSION = '1.0'
+
+MACROS = {
+    'name': NAME,
+    'version': VERSION,
+    'prefix': '/usr',
+    'exec_prefix': '%(prefix)s',
+    'bindir': '%(exec_prefix)s/bin',
+    'sbindir': '%(exec_prefix)s/sbin',
+    'essentialbindir': '/bin',
+    'essentialsbindir': '/sbin',
+    'lib': 'lib',
+    'libdir': '%(exec_prefix)s/%(lib)s',
+    'essentiallibdir': '/%(lib)s',
+    'libexecdir': '%(exec_prefix)s/libexec',
+    'datadir': '%(prefix)s/share',
+    'includedir': '%(prefix)s/include',
+    'mandir': '%(datadir)s/man',
+    'infodir': '%(datadir)s/info',
+    'docdir': '%(datadir)s/doc',
+    'thisdocdir': '%(docdir)s/%(name)s-%(version)s',
+    'sysconfdir': '/etc',
+    'initdir': '%(sysconfdir)s/init.d',
+    'localstatedir': '/var',
+    'servicedir': '/srv',
+    'testdir': '%(localstatedir)s/conary/tests',
+    'thistestdir': '%(testdir)s/%(name)s-%(version)s',
+    'debuglibdir': '/usr/lib/debug',
+    'debugsrcdir': '/usr/src/debug',
+    'userinfodir': '%(sysconfdir)s/conary/userinfo',
+    'groupinfodir': '%(sysconfdir)s/conary/groupinfo',
+    'x11prefix': '%(exec_prefix)s/X11R6',
+    'krbprefix': '%(exec_prefix)s/kerberos',
+    'buildlabel': 'local@local:COOK',
+}
+
+
+class StubConfig(object):
+    def __init__(self, root):
+        self.root = root
+        self.dbPath = '/var/lib/conarydb'
+
+
+class StubTrove(object):
+    def __init__(self, name):
+        self.name = name
+
+    def getName(self):
+        return self.name
+
+
+class StubDatabase(object):
+    """
+    Local database that knows only which trove owns each path in the
+    synthetic system root.
+    """
+    def __init__(self, pathMap):
+        self.pathMap = pathMap
+        self.troveNames = set()
+        for troveNames in pathMap.values():
+            self.troveNames.update(troveNames)
+
+    def iterTrovesByPath(self, path):
+        return [StubTrove(x) for x in self.pathMap.get(path, ())]
+
+    def hasTroveByName(self, name):
+        return name in self.troveNames
+
+    def close(self):
+        pass
+
+
+class StubComponent(object):
+    def __init__(self, name):
+        self.name = name
+        self.requires = deps.DependencySet()
+        self.provides = deps.DependencySet()
+        self.requiresMap = {}
+
+    def getName(self):
+        return self.name
+
+
+class StubAutopkg(object):
+    """
+    Assigns each destdir path to a component by location, roughly as
+    the default C{ComponentSpec} would.
+    """
+    def __init__(self, macros):
+        self.macros = macros
+        self.components = {}
+        self.componentMap = {}
+        self.pathMap = {}
+
+    def componentName(self, path):
+        m = self.macros
+        if (path.startswith(m.includedir + '/')
+            or path.startswith(m.libdir + '/pkgconfig/')
+            or (path.startswith(m.libdir + '/') and path.endswith('.so'))):
+            return 'devel'
+        if path.startswith(m.libdir + '/'):
+            return 'lib'
+        if (path.startswith(m.mandir + '/')
+            or path.startswith(m.infodir + '/')
+            or path.startswith(m.docdir + '/')):
+            return 'doc'
+        return 'runtime'
+
+    def addPath(self, path):
+        name = ':'.join((NAME, self.componentName(path)))
+        component = self.components.get(name)
+        if component is None:
+            component = self.components[name] = StubComponent(name)
+        self.componentMap[path] = component
+        self.pathMap[path] = component
+
+    def findComponent(self, path):
+        return self.componentMap.get(path)
+
+
+class MagicCache(dict):
+    def __init__(self, basedir):
+        dict.__init__(self)
+        self.basedir = basedir
+
+    def __getitem__(self, path):
+        if not dict.__contains__(self, path):
+            dict.__setitem__(self, path, magic.magic(path, self.basedir))
+        return dict.__getitem__(self, path)
+
+
+class StubRecipe(object):
+    """
+    Just enough of a package recipe for policy to run.  Calls to
+    policies, such as C{r.Requires()}, and to the reporting methods in
+    C{recordedMethods} are recorded in C{calls} and otherwise ignored.
+    Any other attribute is missing, so that policy probing for optional
+    recipe features with C{hasattr} behaves as with a recipe that
+    lacks them.
+    """
+    recordedMethods = set(('reportErrors',
+                           'reportMissingBuildRequires',
+                           'reportExcessBuildRequires'))
+    ignoreDeps = False
+    _isDerived = False
+
+    def __init__(self, macros, cfg, autopkg):
+        self.name = NAME
+        self.version = VERSION
+        self.macros = macros
+        self.cfg = cfg
+        self.autopkg = autopkg
+        self.magic = MagicCache(macros.destdir)
+        self.calls = []
+
+    def _getTransitiveBuildRequiresNames(self):
+        return set()
+
+    def __getattr__(self, name):
+        if not (name[:1].isupper() or name in self.recordedMethods):
+            raise AttributeError(name)
+        def call(*args, **keywords):
+            self.calls.append((name, args, keywords))
+        return call
+
+
+def _writeFile(path, contents, mode=0644):
+    dirName = os.path.dirname(path)
+    if not os.path.isdir(dirName):
+        os.makedirs(dirName)
+    f = open(path, 'w')
+    f.write(contents)
+    f.close()
+    os.chmod(path, mode)
+
+
+def _symlink(target, path):
+    dirName = os.path.dirname(path)
+    if not os.path.isdir(dirName):
+        os.makedirs(dirName)
+    os.symlink(target, path)
+
+
+def _findElf():
+    for path in ('/bin/true', '/usr/bin/true', sys.executable):
+        if os.path.isfile(path) and open(path).read(4) == '\177ELF':
+            return path
+    return None
+
+
+class Fixture(object):
+    """
+    Synthetic destdir, builddir and system root.  Each C{make*} method
+    creates one kind of file, C{scale} of them, and returns the paths
+    it created relative to the tree they are in.
+    """
+
+    elfPath = _findElf()
+
+    def __init__(self, topdir, scale):
+        self.scale = scale
+        self.topdir = topdir
+        self.destdir = os.path.join(topdir, 'destdir')
+        self.builddir = os.path.join(topdir, 'builddir')
+        self.root = os.path.join(topdir, 'root')
+        for dirName in (self.destdir, self.builddir, self.root):
+            os.makedirs(dirName)
+
+        macros = conarymacros.Macros()
+        macros.update(MACROS)
+        macros.update({'destdir': self.destdir, 'builddir': self.builddir})
+        self.macros = macros
+        self.autopkg = StubAutopkg(macros)
+        self.systemPaths = {}
+        self.paths = {}
+
+    def add(self, path, contents, mode=0644):
+        _writeFile(self.destdir + path, contents, mode)
+        self.autopkg.addPath(path)
+        return path
+
+    def addSymlink(self, target, path):
+        _symlink(target, self.destdir + path)
+        self.autopkg.addPath(path)
+        return path
+
+    def addSystem(self, path, troveName, contents=''):
+        _writeFile(self.root + path, contents)
+        self.systemPaths[path] = [troveName]
+
+    def makeManPages(self):
+        paths = []
+        for i in range(self.scale):
+            section = (i % 2) and '3' or '1'
+            mandir = '%s/man%s' %(self.macros.mandir, section)
+            name = 'tool%d.%s' %(i, section)
+            if i and i % 5 == 0:
+                contents = '.so man%s/tool%d.%s\n' %(section, i - 2, section)
+            else:
+                contents = ('.TH TOOL%d %s\n.SH NAME\ntool%d\n'
+                            '.SH FILES\n%s/etc/tool%d.conf\n'
+                            %(i, section, i, self.destdir, i)) * 20
+            if i % 4 == 1:
+                paths.append(self.addGzip(mandir + '/' + name + '.gz',
+                                          contents, level=6))
+            else:
+                paths.append(self.add(mandir + '/' + name, contents))
+            if i % 7 == 3:
+                paths.append(self.addSymlink(name,
+                    '%s/tool%d-alias.%s' %(mandir, i, section)))
+        return paths
+
+    def addGzip(self, path, contents, level=9, name=True):
+        _writeFile(self.destdir + path, '')
+        if name:
+            fileName = os.path.basename(path)[:-3]
+        else:
+            fileName = ''
+        f = open(self.destdir + path, 'w')
+        gz = gzip.GzipFile(fileName, 'wb', level, f)
+        gz.write(contents)
+        gz.close()
+        f.close()
+        self.autopkg.addPath(path)
+        return path
+
+    def addBzip2(self, path, contents, level=9):
+        _writeFile(self.destdir + path, '')
+        bz = bz2.BZ2File(self.destdir + path, 'w', 0, level)
+        bz.write(contents)
+        bz.close()
+        self.autopkg.addPath(path)
+        return path
+
+    def makeCompressed(self):
+        paths = []
+        dataDir = '%s/%s/data' %(self.macros.datadir, NAME)
+        for i in range(self.scale):
+            contents = ('record %d: ' %i + 'abcdefghij' * (i % 50 + 1)
+                        + '\n') * 100
+            if i % 3 == 0:
+                # already normalized
+                paths.append(self.addGzip('%s/data%d.txt.gz' %(dataDir, i),
+                                          contents, name=False))
+            elif i % 3 == 1:
+                paths.append(self.addGzip('%s/data%d.txt.gz' %(dataDir, i),
+                                          contents, level=6))
+            else:
+                paths.append(self.addBzip2('%s/data%d.txt.bz2' %(dataDir, i),
+                                           contents, level=1))
+        return paths
+
+    def makeElf(self):
+        if self.elfPath:
+            contents = open(self.elfPath).read()
+        else:
+            contents = '\177ELF' + '\0' * 60
+        paths = []
+        for i in range(self.scale):
+            paths.append(self.add('%s/prog%d' %(self.macros.bindir, i),
+                                  contents, 0755))
+        return paths
+
+    def makeScripts(self):
+        paths = []
+        interpreters = ('/bin/sh', '/usr/bin/env python', '/usr/bin/perl')
+        for i in range(self.scale):
+            interpreter = interpreters[i % len(interpreters)]
+            paths.append(self.add('%s/script%d' %(self.macros.bindir, i),
+                                  '#!%s\n' %interpreter +
+                                  '# script %d\n' %i * 50, 0755))
+        return paths
+
+    def makeSymlinks(self):
+        paths = []
+        farm = '%s/%s/farm' %(self.macros.datadir, NAME)
+        for i in range(self.scale):
+            dirName = '%s/dir%d' %(farm, i % 10)
+            paths.append(self.add('%s/file%d' %(dirName, i), 'file %d\n' %i))
+        for i in range(self.scale):
+            linkDir = '%s/dir%d' %(farm, (i + 1) % 10)
+            target = '../dir%d/file%d' %(i % 10, i)
+            if i % 10 == 9:
+                # resolved through an exception, not the package
+                target = '../../../../../proc/self/fd/%d' %i
+            paths.append(self.addSymlink(target, '%s/link%d' %(linkDir, i)))
+        # developer symlinks into another component
+        libdir = self.macros.libdir
+        for i in range(max(1, self.scale / 10)):
+            self.add('%s/libfarm%d.so.1' %(libdir, i), 'library %d\n' %i)
+            paths.append(self.addSymlink('libfarm%d.so.1' %i,
+                                         '%s/libfarm%d.so' %(libdir, i)))
+        return paths
+
+    def makeDesktopFiles(self):
+        paths = []
+        datadir = self.macros.datadir
+        for i in range(self.scale):
+            if i % 2:
+                icon = 'app%d' %i
+                self.add('%s/icons/hicolor/48x48/apps/app%d.png'
+                         %(datadir, i), '\211PNG\r\n\032\n')
+            else:
+                icon = 'app%d.xpm' %i
+                self.add('%s/pixmaps/app%d.xpm' %(datadir, i), '/* XPM */\n')
+            paths.append(self.add('%s/applications/app%d.desktop'
+                                  %(datadir, i),
+                                  '[Desktop Entry]\nName=App %d\n'
+                                  'Exec=app%d\nIcon=%s\nType=Application\n'
+                                  %(i, i, icon)))
+        return paths
+
+    def makeConfigLogs(self):
+        m = self.macros
+        self.addSystem('/usr/bin/gcc', 'gcc:runtime')
+        self.addSystem('/usr/bin/flex', 'flex:runtime')
+        self.addSystem('/usr/bin/pkg-config', 'pkgconfig:runtime')
+        self.addSystem('%s/zlib.h' %m.includedir, 'zlib:devel')
+        self.addSystem('%s/stdio.h' %m.includedir, 'glibc:devel')
+        stanzas = (
+            'configure:%(n)d: checking for gcc\n'
+            'configure:%(n)d: found /usr/bin/gcc\n'
+            'configure:%(n)d: result: gcc\n'
+            'configure:%(n)d: checking for stdio.h\n'
+            'configure:%(n)d: gcc -c -I/usr/include conftest.c >&5\n'
+            'configure:%(n)d: result: yes\n'
+            'configure:%(n)d: checking for zlib.h\n'
+            'configure:%(n)d: result: yes\n'
+            'configure:%(n)d: checking for pkg-config\n'
+            'configure:%(n)d: result: /usr/bin/pkg-config\n'
+            'configure:%(n)d: checking for frobnicate\n'
+            'configure:%(n)d: result: no\n'
+            'configure:%(n)d: checking whether we are cross compiling\n'
+            'configure:%(n)d: result: no\n'
+        )
+        paths = []
+        for i in range(self.scale):
+            path = '/%s-%s/sub%d/config.log' %(NAME, VERSION, i)
+            contents = ''.join(stanzas %{'n': 1000 + x} for x in range(50))
+            _writeFile(self.builddir + path, contents)
+            paths.append(path)
+        return paths
+
+    def makeCMakeCaches(self):
+        self.addSystem('/usr/bin/gcc', 'gcc:runtime')
+        self.addSystem('/usr/bin/flex', 'flex:runtime')
+        entries = (
+            '//Path to a program.\n'
+            'CMAKE_C_COMPILER_%(n)d:FILEPATH=/usr/bin/gcc\n'
+            '//Path to a program.\n'
+            'FLEX_EXECUTABLE_%(n)d:FILEPATH=/usr/bin/flex\n'
+            'CMAKE_BUILD_TYPE_%(n)d:STRING=Release\n'
+            'FOO_FOUND_%(n)d:BOOL=OFF\n'
+            '\n'
+        )
+        paths = []
+        for i in range(self.scale):
+            path = '/%s-%s/build%d/CMakeCache.txt' %(NAME, VERSION, i)
+            contents = ''.join(entries %{'n': x} for x in range(200))
+            _writeFile(self.builddir + path, contents)
+            paths.append(path)
+        return paths
+
+    def size(self, paths):
+        """
+        Total size of the regular files among C{paths}, which may be
+        in either the destdir or the builddir.
+        """
+        total = 0
+        for path in paths:
+            for topdir in (self.destdir, self.builddir):
+                try:
+                    sb = os.lstat(topdir + path)
+                except OSError:
+                    continue
+                if stat.S_ISREG(sb.st_mode):
+                    total += sb.st_size
+                break
+        return total
+
+    def makePkgConfig(self):
+        paths = []
+        libdir = self.macros.libdir
+        for i in range(self.scale):
+            self.add('%s/libpc%d.so.1' %(libdir, i), 'library %d\n' %i)
+            self.addSymlink('libpc%d.so.1' %i, '%s/libpc%d.so' %(libdir, i))
+            requires = ''
+            if i:
+                requires = 'Requires: pc%d >= 1.0\n' %(i - 1)
+            paths.append(self.add('%s/pkgconfig/pc%d.pc' %(libdir, i),
+                'prefix=/usr\nexec_prefix=${prefix}\n'
+                'libdir=${exec_prefix}/%s\nincludedir=${prefix}/include\n\n'
+                'Name: pc%d\nDescription: synthetic\nVersion: 1.0\n%s'
+                'Libs: -L${libdir} -lpc%d\nCflags: -I${includedir}\n'
+                %(self.macros.lib, i, requires, i)))
+        return paths
+
+
+def _runPolicy(policyObj, recipe, paths):
+    policyObj.doProcess(recipe)
+
+
+def _runPluggable(policyObj, recipe, paths):
+    # pluggable requirement policies are normally driven by Requires
+    macros = recipe.macros
+    policyObj.macros = macros
+    policyObj.systemLibPaths = set((macros.libdir, macros.essentiallibdir))
+    requirements = []
+    def addRequirement(path, troveName, flags, pkgFiles, depClass):
+        requirements.append((path, troveName))
+    policyObj._addRequirement = addRequirement
+    for path in paths:
+        policyObj.addPluggableRequirements(path, macros.destdir + path,
+                                           {}, macros)
+
+
+# (policy, fixture methods; files from the first are what is counted,
+#  runner)
+BENCHMARKS = [
+    ('NormalizeCompression', ('makeCompressed',), _runPolicy),
+    ('NormalizeManPages', ('makeManPages',), _runPolicy),
+    ('NormalizeInterpreterPaths', ('makeScripts',), _runPolicy),
+    ('BadInterpreterPaths', ('makeScripts',), _runPolicy),
+    ('NonBinariesInBindirs', ('makeElf', 'makeScripts'), _runPolicy),
+    ('DanglingSymlinks', ('makeSymlinks',), _runPolicy),
+    ('CheckDesktopFiles', ('makeDesktopFiles',), _runPolicy),
+    ('EnforceConfigLogBuildRequirements', ('makeConfigLogs',), _runPolicy),
+    ('EnforceCMakeCacheBuildRequirements', ('makeCMakeCaches',), _runPolicy),
+    ('PkgConfigRequires', ('makePkgConfig',), _runPluggable),
+]
+
+
+def loadPolicies(policyDir):
+    classes = {}
+    for fileName in sorted(os.listdir(policyDir)):
+        if not fileName.endswith('.py') or fileName.startswith('_'):
+            continue
+        name = fileName[:-3]
+        module = imp.load_source(name, os.path.join(policyDir, fileName))
+        for attr, value in module.__dict__.items():
+            if attr[:1].isupper() and hasattr(value, 'doProcess'):
+                classes[attr] = value
+    return classes
+
+
+def runBenchmark(policyClass, fixtureMethods, runner, scale, workdir):
+    topdir = tempfile.mkdtemp(prefix='policybench-', dir=workdir)
+    try:
+        fixture = Fixture(topdir, scale)
+        paths = []
+        for method in fixtureMethods:
+            paths.extend(getattr(fixture, method)())
+        # measured before the policy runs, since it may rewrite them
+        size = fixture.size(paths)
+        cfg = StubConfig(fixture.root)
+        recipe = StubRecipe(fixture.macros, cfg, fixture.autopkg)
+        _policyutil = sys.modules['_policyutil']
+        _policyutil.useDatabase(recipe, StubDatabase(fixture.systemPaths))
+
+        policyObj = policyClass(recipe)
+        start = time.time()
+        runner(policyObj, recipe, paths)
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(topdir)
+    return len(paths), size, elapsed, recipe.calls
+
+
+def main(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] [policy ...]')
+    parser.add_option('--scale', type='int', default=200,
+        help='number of files of each kind to generate (default 200)')
+    parser.add_option('--repeat', type='int', default=3,
+        help='runs per policy; the fastest is reported (default 3)')
+    parser.add_option('--policy-dir',
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'policy'),
+        help='directory to load policy from (default ../policy)')
+    parser.add_option('--workdir', default=None,
+        help='where to generate the synthetic trees (default $TMPDIR)')
+    parser.add_option('--list', action='store_true', default=False,
+        help='list the policies that can be benchmarked')
+    options, args = parser.parse_args(argv)
+
+    benchmarks = BENCHMARKS
+    if options.list:
+        for name, fixtureMethods, runner in benchmarks:
+            print name
+        return 0
+    if args:
+        known = set(x[0] for x in benchmarks)
+        unknown = [x for x in args if x not in known]
+        if unknown:
+            parser.error('no benchmark for: %s' %', '.join(unknown))
+        benchmarks = [x for x in benchmarks if x[0] in args]
+
+    classes = loadPolicies(os.path.abspath(options.policy_dir))
+
+    print '%-36s %7s %9s %11s %8s %6s' %('policy', 'files', 'seconds',
+                                         'files/sec', 'MB/sec', 'calls')
+    for name, fixtureMethods, runner in benchmarks:
+        best = None
+        for i in range(options.repeat):
+            files, size, elapsed, calls = runBenchmark(classes[name],
+                fixtureMethods, runner, options.scale, options.workdir)
+            if best is None or elapsed < best:
+                best = elapsed
+        if best:
+            rate = '%11.1f' %(files / best)
+            byteRate = '%8.2f' %(size / best / (1024 * 1024))
+        else:
+            rate = '%11s' %'-'
+            byteRate = '%8s' %'-'
+        print '%-36s %7d %9.4f %s %s %6d' %(name, files, best, rate,
+                                            byteRate, len(calls))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))